@@ -1,26 +1,353 @@
-from fastapi import FastAPI, APIRouter, HTTPException
+from fastapi import FastAPI, APIRouter, HTTPException, Query, Request
+from fastapi.responses import JSONResponse, ORJSONResponse, PlainTextResponse, Response, StreamingResponse
 from dotenv import load_dotenv
+from starlette.datastructures import Headers, MutableHeaders
 from starlette.middleware.cors import CORSMiddleware
+from starlette.routing import Match
 from motor.motor_asyncio import AsyncIOMotorClient
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING, IndexModel, ReturnDocument, UpdateOne, monitoring
+from pymongo.errors import BulkWriteError, DuplicateKeyError, ExecutionTimeout, OperationFailure
+from pymongo.read_preferences import Nearest, Primary, PrimaryPreferred, Secondary, SecondaryPreferred
 import os
+import socket
 import logging
+import re
+import json
+import base64
+import gzip
+import hashlib
+import csv
+import io
 from pathlib import Path
-from pydantic import BaseModel, Field
-from typing import List, Optional
+from pydantic import BaseModel, Field, ValidationError, field_validator
+from typing import Dict, List, Literal, Optional
 import uuid
 from datetime import datetime, timezone, date, timedelta
 from enum import Enum
-import random
+import time
+import asyncio
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+import importlib.util
+from urllib.parse import urlsplit
 import httpx
+import numpy as np
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
-# MongoDB connection
+def env_flag(name: str, default: bool = False) -> bool:
+    """Read a boolean flag from the environment"""
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+# Metrics (Prometheus text exposition format)
+def _format_labels(labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
+
+class Counter:
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self._values = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"]
+        lines += [f"{self.name}{_format_labels(key)} {value}" for key, value in self._values.items()]
+        return lines
+
+class Gauge(Counter):
+    def set(self, value: float, **labels):
+        self._values[tuple(sorted(labels.items()))] = value
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        lines[1] = f"# TYPE {self.name} gauge"
+        return lines
+
+class Histogram:
+    DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self, name: str, description: str, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        self._series = {}  # labels -> [bucket counts, sum, count]
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[0][i] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        for key, (bucket_counts, total, count) in self._series.items():
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                lines.append(f"{self.name}_bucket{_format_labels(key + (('le', bound),))} {bucket_count}")
+            lines.append(f"{self.name}_bucket{_format_labels(key + (('le', '+Inf'),))} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {count}")
+        return lines
+
+REQUEST_DURATION = Histogram("http_request_duration_seconds", "HTTP request latency by route")
+STAGE_DURATION = Histogram("handler_stage_duration_seconds", "Latency of stages inside request handlers")
+STATISTICS_FALLBACKS = Counter("statistics_fallbacks_total", "Statistics served from a fallback source")
+CACHE_EVENTS = Gauge("cache_events_total", "In-process cache counters")
+MONGO_POOL = Gauge("mongo_pool_connections", "MongoDB pool connections by state")
+MONGO_POOL_CHECKOUT_FAILURES = Counter("mongo_pool_checkout_failures_total", "Failed MongoDB connection checkouts")
+CIRCUIT_STATE = Gauge("circuit_breaker_state", "Circuit breaker state (0 closed, 1 half-open, 2 open)")
+CIRCUIT_TIMEOUT = Gauge("circuit_breaker_timeout_seconds", "Current adaptive upstream timeout")
+CIRCUIT_SHORT_CIRCUITS = Gauge("circuit_breaker_short_circuits_total", "Calls rejected by an open circuit")
+REQUESTS_REJECTED = Counter("admission_rejected_total", "Requests rejected by rate limits or a full expensive pool")
+EXPENSIVE_IN_FLIGHT = Gauge("expensive_requests_in_flight", "Expensive requests holding a pool slot")
+
+@contextmanager
+def timed(stage: str):
+    """Record how long the enclosed block takes as a handler stage"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_DURATION.observe(time.perf_counter() - started, stage=stage)
+
+class MongoPoolListener(monitoring.ConnectionPoolListener):
+    """Track open and checked-out connections of the Motor client pools"""
+
+    def __init__(self):
+        self.open = 0
+        self.checked_out = 0
+
+    def _update(self):
+        MONGO_POOL.set(self.open, state="open")
+        MONGO_POOL.set(self.checked_out, state="checked_out")
+
+    def connection_created(self, event):
+        self.open += 1
+        self._update()
+
+    def connection_closed(self, event):
+        self.open -= 1
+        self._update()
+
+    def connection_checked_out(self, event):
+        self.checked_out += 1
+        self._update()
+
+    def connection_checked_in(self, event):
+        self.checked_out -= 1
+        self._update()
+
+    def connection_check_out_failed(self, event):
+        MONGO_POOL_CHECKOUT_FAILURES.inc(reason=event.reason)
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_check_out_started(self, event):
+        pass
+
+# MongoDB connection (one client, and so one pool, per worker process)
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+MONGO_MAX_POOL_SIZE = int(os.environ.get('MONGO_MAX_POOL_SIZE', '100'))
+MONGO_MIN_POOL_SIZE = int(os.environ.get('MONGO_MIN_POOL_SIZE', '0'))
+MONGO_MAX_IDLE_TIME_MS = os.environ.get('MONGO_MAX_IDLE_TIME_MS')
+# tz_aware: dates are stored as native BSON dates and decoded as UTC datetimes
+client = AsyncIOMotorClient(
+    mongo_url,
+    tz_aware=True,
+    maxPoolSize=MONGO_MAX_POOL_SIZE,
+    minPoolSize=MONGO_MIN_POOL_SIZE,
+    maxIdleTimeMS=int(MONGO_MAX_IDLE_TIME_MS) if MONGO_MAX_IDLE_TIME_MS else None,
+    event_listeners=[MongoPoolListener()]
+)
 db = client[os.environ['DB_NAME']]
 
+# Read routing: detail reads (right after writes) use `db` on the primary;
+# analytics and list scans may go to secondaries
+MONGO_ANALYTICS_READ_PREFERENCE = os.environ.get('MONGO_ANALYTICS_READ_PREFERENCE', 'secondaryPreferred')
+MONGO_LIST_READ_PREFERENCE = os.environ.get('MONGO_LIST_READ_PREFERENCE', MONGO_ANALYTICS_READ_PREFERENCE)
+# Max replication lag tolerated on secondary reads (MongoDB requires >= 90, -1 disables)
+MONGO_MAX_STALENESS_SECONDS = int(os.environ.get('MONGO_MAX_STALENESS_SECONDS', '90'))
+# Server-side time limit for expensive statistics and list queries
+MONGO_MAX_TIME_MS = int(os.environ.get('MONGO_MAX_TIME_MS', '15000'))
+# Exports run much longer; unset means no limit
+MONGO_EXPORT_MAX_TIME_MS = os.environ.get('MONGO_EXPORT_MAX_TIME_MS')
+
+def read_preference(name: str):
+    """Build a pymongo read preference from its mode name"""
+    modes = {
+        "primary": Primary,
+        "primaryPreferred": PrimaryPreferred,
+        "secondary": Secondary,
+        "secondaryPreferred": SecondaryPreferred,
+        "nearest": Nearest
+    }
+    if name not in modes:
+        raise ValueError(f"Unknown read preference: {name}")
+    if name == "primary":
+        return Primary()
+    return modes[name](max_staleness=MONGO_MAX_STALENESS_SECONDS)
+
+analytics_db = client.get_database(os.environ['DB_NAME'], read_preference=read_preference(MONGO_ANALYTICS_READ_PREFERENCE))
+list_db = client.get_database(os.environ['DB_NAME'], read_preference=read_preference(MONGO_LIST_READ_PREFERENCE))
+
+# "development" prints routes and seeds test data; "production" never seeds
+STARTUP_MODE = os.environ.get('STARTUP_MODE', 'development')
+# How long the startup leader lock lasts without renewal before others may take over
+STARTUP_LOCK_TTL = float(os.environ.get('STARTUP_LOCK_TTL', '600'))
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+def startup_deploy_id() -> str:
+    """Identifier shared by all workers of one launch; startup seeding runs once per value.
+
+    STARTUP_DEPLOY_ID (a release or commit, set by `serve` when missing)
+    wins. Workers of a uvicorn/gunicorn master are recognised by the
+    master's pid and start time; any other process (e.g. under systemd or
+    as PID 1 in a container) is a launch of its own.
+    """
+    deploy_id = os.environ.get('STARTUP_DEPLOY_ID')
+    if deploy_id:
+        return deploy_id
+    parent = os.getppid()
+    try:
+        with open(f"/proc/{parent}/cmdline", "rb") as cmdline:
+            command = cmdline.read()
+        with open(f"/proc/{parent}/stat") as stat:
+            started = stat.read().rsplit(")", 1)[1].split()[19]
+    except (OSError, IndexError):
+        return WORKER_ID
+    if b"uvicorn" not in command and b"gunicorn" not in command:
+        return WORKER_ID
+    return f"{socket.gethostname()}:{parent}:{started}"
+
+# Statistics are computed from MongoDB; the n8n webhook is only used as a fallback
+STATISTICS_WEBHOOK_FALLBACK = env_flag('STATISTICS_WEBHOOK_FALLBACK')
+# "embedded" keeps messages inside chat documents, "collection" stores them
+# in the messages collection with running counters on the chat
+CHAT_STORAGE = os.environ.get('CHAT_STORAGE', 'embedded')
+
+# Closed time-series buckets kept in memory. They still change (late messages,
+# cost spread by each chat's current cost per token), so entries expire and
+# other workers converge within the TTL.
+TIMESERIES_CACHE_SIZE = int(os.environ.get('TIMESERIES_CACHE_SIZE', '20000'))
+TIMESERIES_CACHE_TTL = float(os.environ.get('TIMESERIES_CACHE_TTL', '300'))
+TIMESERIES_MAX_BUCKETS = int(os.environ.get('TIMESERIES_MAX_BUCKETS', '2000'))
+
+# Rows fetched per cursor batch and written per output chunk by the exports
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', '1000'))
+
+# Ingestion limits and how long changed days wait before daily_stats is refreshed
+INGEST_MAX_EVENTS = int(os.environ.get('INGEST_MAX_EVENTS', '10000'))
+DAILY_STATS_REFRESH_DELAY = float(os.environ.get('DAILY_STATS_REFRESH_DELAY', '5'))
+
+# Most chats returned by one POST /api/chats/batch call
+CHATS_BATCH_MAX_IDS = int(os.environ.get('CHATS_BATCH_MAX_IDS', '200'))
+
+# "mongo" computes statistics locally first, "webhook" asks n8n first
+STATISTICS_SOURCE = os.environ.get('STATISTICS_SOURCE', 'mongo')
+# "aggregate" scans chats/deals, "rollup" sums the daily_stats collection (day granularity)
+STATISTICS_ENGINE = os.environ.get('STATISTICS_ENGINE', 'aggregate')
+
+# Test data on startup: "wipe" regenerates everything, "if-empty" only seeds
+# an empty database, "off" leaves the data alone
+SEED_ON_STARTUP = os.environ.get('SEED_ON_STARTUP', 'wipe')
+
+# Outbound HTTP client settings for n8n webhooks
+N8N_BASE_URL = os.environ.get('N8N_BASE_URL', 'https://n8n210980.hostkey.in').rstrip('/')
+HTTP_MAX_CONNECTIONS = int(os.environ.get('HTTP_MAX_CONNECTIONS', '100'))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get('HTTP_MAX_KEEPALIVE_CONNECTIONS', '20'))
+HTTP_KEEPALIVE_EXPIRY = float(os.environ.get('HTTP_KEEPALIVE_EXPIRY', '30'))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', '5'))
+HTTP_READ_TIMEOUT = float(os.environ.get('HTTP_READ_TIMEOUT', '30'))
+HTTP_PER_HOST_CONCURRENCY = int(os.environ.get('HTTP_PER_HOST_CONCURRENCY', '20'))
+# HTTP/2 needs the optional "h2" package
+HTTP2_ENABLED = env_flag('HTTP2_ENABLED', True) and importlib.util.find_spec('h2') is not None
+
+# Serve chat endpoints with orjson from pre-shaped dicts (needs the optional "orjson" package)
+FAST_JSON_RESPONSES = env_flag('FAST_JSON_RESPONSES') and importlib.util.find_spec('orjson') is not None
+
+# Compress buffered responses of at least this many bytes (0 disables)
+COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', '1024'))
+COMPRESSION_GZIP_LEVEL = int(os.environ.get('COMPRESSION_GZIP_LEVEL', '6'))
+# Larger responses are sent as they are rather than buffered for compression
+COMPRESSION_MAX_SIZE = int(os.environ.get('COMPRESSION_MAX_SIZE', str(8 * 1024 * 1024)))
+# Brotli is preferred when the client accepts it and the optional "brotli" package is installed
+COMPRESSION_BROTLI_QUALITY = int(os.environ.get('COMPRESSION_BROTLI_QUALITY', '4'))
+BROTLI_AVAILABLE = importlib.util.find_spec('brotli') is not None
+
+# Statistics cache settings (seconds / number of date ranges)
+STATISTICS_CACHE_TTL = float(os.environ.get('STATISTICS_CACHE_TTL', '30'))
+STATISTICS_CACHE_STALE_TTL = float(os.environ.get('STATISTICS_CACHE_STALE_TTL', '300'))
+STATISTICS_CACHE_SIZE = int(os.environ.get('STATISTICS_CACHE_SIZE', '256'))
+
+# Live feed: events buffered per connected admin before it must resync
+EVENTS_QUEUE_SIZE = int(os.environ.get('EVENTS_QUEUE_SIZE', '100'))
+EVENTS_KEEPALIVE_SECONDS = float(os.environ.get('EVENTS_KEEPALIVE_SECONDS', '15'))
+
+# TTL for cached reads of the schedule, toggle-bot and mailing webhooks
+WEBHOOK_CACHE_TTL = float(os.environ.get('WEBHOOK_CACHE_TTL', '10'))
+
+# Circuit breaker around the n8n statistics webhook
+WEBHOOK_BREAKER_WINDOW = int(os.environ.get('WEBHOOK_BREAKER_WINDOW', '20'))
+WEBHOOK_BREAKER_MIN_CALLS = int(os.environ.get('WEBHOOK_BREAKER_MIN_CALLS', '5'))
+WEBHOOK_BREAKER_FAILURE_RATE = float(os.environ.get('WEBHOOK_BREAKER_FAILURE_RATE', '0.5'))
+WEBHOOK_BREAKER_SLOW_CALL_RATE = float(os.environ.get('WEBHOOK_BREAKER_SLOW_CALL_RATE', '0.5'))
+WEBHOOK_BREAKER_SLOW_CALL_SECONDS = float(os.environ.get('WEBHOOK_BREAKER_SLOW_CALL_SECONDS', '5'))
+WEBHOOK_BREAKER_COOLDOWN = float(os.environ.get('WEBHOOK_BREAKER_COOLDOWN', '30'))
+WEBHOOK_TIMEOUT_MIN = float(os.environ.get('WEBHOOK_TIMEOUT_MIN', '1'))
+WEBHOOK_TIMEOUT_MAX = float(os.environ.get('WEBHOOK_TIMEOUT_MAX', os.environ.get('HTTP_READ_TIMEOUT', '30')))
+
+# Token-bucket rate limits per route and client (requests per second / burst size)
+RATE_LIMIT_ENABLED = env_flag('RATE_LIMIT_ENABLED', True)
+RATE_LIMIT_RATE = float(os.environ.get('RATE_LIMIT_RATE', '10'))
+RATE_LIMIT_BURST = float(os.environ.get('RATE_LIMIT_BURST', '50'))
+RATE_LIMIT_EXPENSIVE_RATE = float(os.environ.get('RATE_LIMIT_EXPENSIVE_RATE', '0.2'))
+RATE_LIMIT_EXPENSIVE_BURST = float(os.environ.get('RATE_LIMIT_EXPENSIVE_BURST', '5'))
+# "memory" keeps buckets per worker, "mongo" shares them between workers
+RATE_LIMIT_STORAGE = os.environ.get('RATE_LIMIT_STORAGE', 'memory')
+# Routes never limited (the bot's ingestion path by default)
+RATE_LIMIT_EXEMPT_ROUTES = set(filter(None, os.environ.get('RATE_LIMIT_EXEMPT_ROUTES', '/api/ingest').split(',')))
+# Identify clients by the first X-Forwarded-For address (only behind a trusted proxy)
+RATE_LIMIT_TRUST_PROXY = env_flag('RATE_LIMIT_TRUST_PROXY')
+
+# Expensive requests run in a bounded pool; others wait up to the queue timeout
+EXPENSIVE_CONCURRENCY = int(os.environ.get('EXPENSIVE_CONCURRENCY', '4'))
+EXPENSIVE_QUEUE_TIMEOUT = float(os.environ.get('EXPENSIVE_QUEUE_TIMEOUT', '10'))
+# Chat pages beyond this offset and statistics periods longer than this count as expensive
+EXPENSIVE_CHATS_OFFSET = int(os.environ.get('EXPENSIVE_CHATS_OFFSET', '1000'))
+EXPENSIVE_PERIOD_DAYS = float(os.environ.get('EXPENSIVE_PERIOD_DAYS', '31'))
+
+# Shared outbound client, created on startup and closed on shutdown
+http_client: Optional[httpx.AsyncClient] = None
+_host_semaphores = {}
+
 # Create the main app without a prefix
 app = FastAPI(title="Жилищный баланс - Админ панель")
 
@@ -47,7 +374,8 @@ class ChatMessage(BaseModel):
     message: str
     tokens_used: int = 0  # Количество токенов для этого сообщения
     
-class Chat(BaseModel):
+class ChatSummary(BaseModel):
+    """Chat header fields used by list views (no message history)"""
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     client_id: str
     client_name: str
@@ -55,11 +383,13 @@ class Chat(BaseModel):
     status: ChatStatus
     started_at: datetime
     last_message_at: datetime
-    messages: List[ChatMessage] = []
     total_interactions: int = 0
     dialog_cost: float = 0.0
     total_tokens_used: int = 0  # Общее количество токенов для чата
 
+class Chat(ChatSummary):
+    messages: List[ChatMessage] = []
+
 class Deal(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     client_id: str
@@ -69,6 +399,60 @@ class Deal(BaseModel):
     updated_at: datetime
     estimated_cost: float = 0.0
 
+class TimeseriesBucket(BaseModel):
+    start: datetime
+    new_chats: int = 0
+    chats_by_status: Dict[str, int] = {}
+    deals_by_status: Dict[str, int] = {}
+    conversions: int = 0  # Deals with a (individual) consultation scheduled
+    total_tokens_used: int = 0
+    total_cost: float = 0.0
+
+class TimeseriesResponse(BaseModel):
+    bucket: str
+    period_start: str
+    period_end: str
+    buckets: List[TimeseriesBucket]
+
+def _assume_utc(value: Optional[datetime]) -> Optional[datetime]:
+    # Naive timestamps are UTC, as for query parameters; mixing both kinds breaks min()/max()
+    if value is not None and value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value
+
+class IngestMessage(ChatMessage):
+    id: str  # Required: a retried event must carry the same id to be skipped
+
+    _timestamp_utc = field_validator("timestamp")(_assume_utc)
+
+class IngestMessageEvent(BaseModel):
+    """A chat message pushed by the bot workflow; ``message.id`` makes it idempotent"""
+    type: Literal["message"]
+    client_id: str
+    client_name: Optional[str] = None
+    client_phone: Optional[str] = None
+    status: Optional[ChatStatus] = None
+    dialog_cost: float = 0.0  # Added to the chat's dialog_cost
+    message: IngestMessage
+
+class IngestDealEvent(BaseModel):
+    type: Literal["deal"]
+    id: str
+    client_id: str
+    client_name: str
+    status: DealStatus
+    created_at: Optional[datetime] = None
+    updated_at: Optional[datetime] = None
+    estimated_cost: float = 0.0
+
+    _dates_utc = field_validator("created_at", "updated_at")(_assume_utc)
+
+class IngestResponse(BaseModel):
+    accepted_messages: int
+    duplicate_messages: int
+    deals: int
+    rejected: List[dict] = []
+
 class StatisticsResponse(BaseModel):
     total_deals: int
     consultation_scheduled: int
@@ -82,144 +466,954 @@ class StatisticsResponse(BaseModel):
     period_start: str
     period_end: str
 
+class MessageWindowResponse(BaseModel):
+    messages: List[ChatMessage]
+    has_more: bool  # More messages exist beyond the window in the paging direction
+
 class ChatListResponse(BaseModel):
-    chats: List[Chat]
-    total: int
+    chats: List[ChatSummary]
+    total: Optional[int] = None  # None when the caller skipped counting
+    next_cursor: Optional[str] = None  # Pass as `after` to get the next page
 
-# Generate test data function
-async def generate_test_data():
-    """Generate test data for demonstration"""
+class ChatBatchRequest(BaseModel):
+    client_ids: List[str]
+    include_messages: bool = False
+    messages_limit: Optional[int] = Field(default=None, gt=0)  # Only the latest N messages
+
+class ChatBatchEntry(ChatSummary):
+    messages: Optional[List[ChatMessage]] = None  # None unless include_messages was set
+
+class ChatBatchResponse(BaseModel):
+    chats: List[ChatBatchEntry]  # In the order of the requested client_ids
+    missing: List[str] = []  # Requested client_ids without a chat
+
+# In-process cache
+class AsyncTTLCache:
+    """Bounded LRU cache with TTL eviction and stale-while-revalidate.
+
+    Entries younger than ``ttl`` are served as-is. Entries younger than
+    ``ttl + stale_ttl`` are served immediately while a background task
+    refreshes them. Concurrent loads of the same key share one upstream call.
+    Invalidating a key also disowns loads already in flight: they neither
+    store their result nor are joined by later callers.
+    """
+
+    def __init__(self, name: str, maxsize: int, ttl: float, stale_ttl: float = 0.0):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self._entries = OrderedDict()  # key -> (value, stored_at)
+        self._inflight = {}  # key -> (asyncio.Task, generation it was started in)
+        self._generations = {}  # key -> invalidation count
+        self._epoch = 0  # Full invalidations
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.refresh_errors = 0
+
+    async def get_or_load(self, key, loader):
+        entry = self._entries.get(key)
+        if entry is not None:
+            value, stored_at = entry
+            age = time.monotonic() - stored_at
+            if age < self.ttl:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return value
+            if age < self.ttl + self.stale_ttl:
+                self.stale_hits += 1
+                self._entries.move_to_end(key)
+                if self._current_load(key) is None:
+                    self._start_load(key, loader).add_done_callback(self._log_refresh_error)
+                return value
+            del self._entries[key]
+
+        self.misses += 1
+        task = self._current_load(key)
+        if task is None:
+            task = self._start_load(key, loader)
+        else:
+            self.coalesced += 1
+        # Shield so a cancelled caller does not cancel the load shared with others
+        return await asyncio.shield(task)
+
+    def invalidate(self, key=None):
+        """Drop one key, or every entry when no key is given"""
+        if key is None:
+            self._entries.clear()
+            self._generations.clear()
+            self._epoch += 1
+        else:
+            self._entries.pop(key, None)
+            self._generations[key] = self._generations.get(key, 0) + 1
+
+    def stats(self) -> dict:
+        return {
+            "name": self.name,
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "inflight": len(self._inflight),
+            "refresh_errors": self.refresh_errors
+        }
+
+    def _generation(self, key):
+        return self._epoch, self._generations.get(key, 0)
+
+    def _current_load(self, key) -> Optional[asyncio.Task]:
+        """In-flight load of ``key`` started after its last invalidation"""
+        inflight = self._inflight.get(key)
+        if inflight is not None and inflight[1] == self._generation(key):
+            return inflight[0]
+        return None
+
+    def _start_load(self, key, loader) -> asyncio.Task:
+        generation = self._generation(key)
+        task = asyncio.ensure_future(self._load(key, loader, generation))
+        self._inflight[key] = (task, generation)
+        return task
+
+    async def _load(self, key, loader, generation):
+        try:
+            value = await loader()
+            # Invalidated while loading: the value may predate the write
+            if generation == self._generation(key):
+                self._entries[key] = (value, time.monotonic())
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+            return value
+        finally:
+            inflight = self._inflight.get(key)
+            if inflight is not None and inflight[0] is asyncio.current_task():
+                del self._inflight[key]
+
+    def _log_refresh_error(self, task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            self.refresh_errors += 1
+            logger.warning(f"Background refresh of {self.name} cache failed: {task.exception()}")
+
+# Closed time-series buckets: (unit, bucket start) -> (TimeseriesBucket, stored_at)
+timeseries_cache = OrderedDict()
+
+def cached_timeseries_bucket(key) -> Optional[TimeseriesBucket]:
+    entry = timeseries_cache.get(key)
+    if entry is None:
+        return None
+    value, stored_at = entry
+    if time.monotonic() - stored_at >= TIMESERIES_CACHE_TTL:
+        del timeseries_cache[key]
+        return None
+    timeseries_cache.move_to_end(key)
+    return value
+
+def invalidate_statistics():
+    """Drop cached statistics after chats or deals were rewritten"""
+    statistics_cache.invalidate()
+    timeseries_cache.clear()
+
+webhook_cache = AsyncTTLCache("webhooks", maxsize=64, ttl=WEBHOOK_CACHE_TTL)
+
+# Circuit breaker
+class CircuitOpenError(Exception):
+    """Raised instead of calling an upstream whose circuit is open"""
+
+class CircuitBreaker:
+    """Circuit breaker with failure-rate/slow-call thresholds and adaptive timeouts.
+
+    The breaker opens when, over the last ``window`` calls (at least
+    ``min_calls``), the failure rate or the share of calls slower than
+    ``slow_call_seconds`` reaches its threshold. After ``cooldown`` seconds
+    a single half-open probe is let through: success closes the circuit,
+    failure opens it again.
+
+    Each call gets a timeout of ``timeout_multiplier`` times the observed
+    p95 latency of successful calls, clamped to ``min_timeout``..``max_timeout``.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str, window: int, min_calls: int, failure_rate: float,
+                 slow_call_rate: float, slow_call_seconds: float, cooldown: float,
+                 min_timeout: float, max_timeout: float, timeout_multiplier: float = 3.0):
+        self.name = name
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_call_rate = slow_call_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.cooldown = cooldown
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.timeout_multiplier = timeout_multiplier
+        self.state = self.CLOSED
+        self._outcomes = deque(maxlen=window)  # (failed, slow)
+        self._latencies = deque(maxlen=max(window, 100))
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self.short_circuited = 0
+
+    def timeout(self) -> float:
+        if len(self._latencies) < self.min_calls:
+            return self.max_timeout
+        latencies = sorted(self._latencies)
+        p95 = latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))]
+        return min(self.max_timeout, max(self.min_timeout, p95 * self.timeout_multiplier))
+
+    def _allow(self) -> bool:
+        if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.cooldown:
+            self.state = self.HALF_OPEN
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.HALF_OPEN and not self._probe_in_flight:
+            self._probe_in_flight = True
+            return True
+        return False
+
+    def _record(self, failed: bool, duration: float):
+        slow = duration >= self.slow_call_seconds
+        if not failed:
+            self._latencies.append(duration)
+
+        if self.state == self.HALF_OPEN:
+            self._probe_in_flight = False
+            if failed or slow:
+                self._open()
+            else:
+                self.state = self.CLOSED
+                self._outcomes.clear()
+            return
+
+        self._outcomes.append((failed, slow))
+        if len(self._outcomes) < self.min_calls:
+            return
+        failures = sum(1 for f, _ in self._outcomes if f) / len(self._outcomes)
+        slow_calls = sum(1 for _, s in self._outcomes if s) / len(self._outcomes)
+        if failures >= self.failure_rate or slow_calls >= self.slow_call_rate:
+            self._open()
+
+    def _open(self):
+        if self.state != self.OPEN:
+            logger.warning(f"Circuit {self.name} opened for {self.cooldown}s")
+        self.state = self.OPEN
+        self._opened_at = time.monotonic()
+        self._outcomes.clear()
+
+    async def call(self, func):
+        """Run ``func(timeout)`` through the breaker"""
+        if not self._allow():
+            self.short_circuited += 1
+            raise CircuitOpenError(f"circuit {self.name} is {self.state}")
+        started = time.monotonic()
+        try:
+            result = await func(self.timeout())
+        except BaseException as e:
+            # A cancelled caller says nothing about upstream health
+            if isinstance(e, asyncio.CancelledError):
+                if self.state == self.HALF_OPEN:
+                    self._probe_in_flight = False
+            else:
+                self._record(True, time.monotonic() - started)
+            raise
+        self._record(False, time.monotonic() - started)
+        return result
+
+    def stats(self) -> dict:
+        return {
+            "name": self.name,
+            "state": self.state,
+            "timeout": round(self.timeout(), 3),
+            "short_circuited": self.short_circuited
+        }
+
+statistics_webhook_breaker = CircuitBreaker(
+    "statistics_webhook",
+    window=WEBHOOK_BREAKER_WINDOW,
+    min_calls=WEBHOOK_BREAKER_MIN_CALLS,
+    failure_rate=WEBHOOK_BREAKER_FAILURE_RATE,
+    slow_call_rate=WEBHOOK_BREAKER_SLOW_CALL_RATE,
+    slow_call_seconds=WEBHOOK_BREAKER_SLOW_CALL_SECONDS,
+    cooldown=WEBHOOK_BREAKER_COOLDOWN,
+    min_timeout=WEBHOOK_TIMEOUT_MIN,
+    max_timeout=WEBHOOK_TIMEOUT_MAX
+)
+
+statistics_cache = AsyncTTLCache(
+    "statistics",
+    maxsize=STATISTICS_CACHE_SIZE,
+    ttl=STATISTICS_CACHE_TTL,
+    stale_ttl=STATISTICS_CACHE_STALE_TTL
+)
+
+# Outbound HTTP
+def create_http_client() -> httpx.AsyncClient:
+    """Create the application-wide pooled client used for all webhook calls"""
+    return httpx.AsyncClient(
+        http2=HTTP2_ENABLED,
+        limits=httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY
+        ),
+        timeout=httpx.Timeout(
+            HTTP_READ_TIMEOUT,
+            connect=HTTP_CONNECT_TIMEOUT,
+            pool=HTTP_CONNECT_TIMEOUT
+        )
+    )
+
+def _host_semaphore(url: str) -> asyncio.Semaphore:
+    host = urlsplit(url).netloc
+    if host not in _host_semaphores:
+        _host_semaphores[host] = asyncio.Semaphore(HTTP_PER_HOST_CONCURRENCY)
+    return _host_semaphores[host]
+
+async def webhook_request(method: str, path: str, **kwargs) -> httpx.Response:
+    """Call an n8n webhook through the shared client.
+
+    ``path`` is relative to N8N_BASE_URL (e.g. ``/webhook/gb/schedule``).
+    Concurrent calls to the same host are capped by HTTP_PER_HOST_CONCURRENCY.
+    The response is returned after ``raise_for_status``.
+    """
+    global http_client
+    if http_client is None:
+        http_client = create_http_client()
+
+    url = f"{N8N_BASE_URL}{path}"
+    async with _host_semaphore(url):
+        response = await http_client.request(method, url, **kwargs)
+    response.raise_for_status()
+    return response
+
+# Indexes and search
+def chat_search_fields(client_name: str, client_phone: str) -> dict:
+    """Normalized fields backing the indexed prefix search on chats"""
+    return {
+        "name_tokens": client_name.lower().split(),
+        "phone_digits": re.sub(r"\D", "", client_phone)
+    }
+
+def build_chat_search_query(search: str) -> dict:
+    """Build an index-friendly chats query from a free-text search.
+
+    Every word must prefix-match a word of the client name. A search made
+    only of phone characters also prefix-matches the digits of the phone.
+    """
+    words = search.lower().split()
+    if not words:
+        return {}
+    query = {"name_tokens": {"$all": [re.compile(f"^{re.escape(word)}") for word in words]}}
+
+    digits = re.sub(r"\D", "", search)
+    if digits and not re.sub(r"[\d\s+()\-]", "", search):
+        query = {"$or": [query, {"phone_digits": {"$regex": f"^{digits}"}}]}
+    return query
+
+async def ensure_indexes():
+    """Create the indexes used by list, search and statistics queries"""
+    await db.chats.create_indexes([
+        IndexModel([("last_message_at", DESCENDING), ("id", DESCENDING)]),
+        IndexModel([("client_id", ASCENDING)], unique=True),
+        IndexModel([("status", ASCENDING), ("started_at", ASCENDING)]),
+        IndexModel([("started_at", ASCENDING)]),
+        IndexModel([("name_tokens", ASCENDING)]),
+        IndexModel([("phone_digits", ASCENDING)])
+    ])
+    await db.deals.create_indexes([
+        IndexModel([("created_at", ASCENDING)]),
+        IndexModel([("client_id", ASCENDING)]),
+        IndexModel([("id", ASCENDING)], unique=True)
+    ])
+    await db.messages.create_indexes([
+        IndexModel([("chat_id", ASCENDING), ("timestamp", ASCENDING)]),
+        IndexModel([("timestamp", ASCENDING)]),
+        IndexModel([("id", ASCENDING)], unique=True)
+    ])
+    if RATE_LIMIT_STORAGE == "mongo":
+        await db.rate_limits.create_indexes([
+            IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=0)
+        ])
+
+async def backfill_search_fields():
+    """Populate search fields on chats written before they existed"""
+    updates = []
+    cursor = db.chats.find(
+        {"phone_digits": {"$exists": False}},
+        {"_id": 1, "client_name": 1, "client_phone": 1}
+    )
+    async for chat in cursor:
+        updates.append(UpdateOne(
+            {"_id": chat["_id"]},
+            {"$set": chat_search_fields(chat.get("client_name", ""), chat.get("client_phone", ""))}
+        ))
+        if len(updates) >= 1000:
+            await db.chats.bulk_write(updates, ordered=False)
+            updates = []
+    if updates:
+        await db.chats.bulk_write(updates, ordered=False)
+
+# List queries never pull the embedded message history or search fields
+CHAT_SUMMARY_PROJECTION = {"_id": 0, "messages": 0, "name_tokens": 0, "phone_digits": 0}
+
+# Fast response path
+class FastJSONResponse(ORJSONResponse):
+    """ORJSONResponse writing UTC datetimes with a "Z" suffix, as the Pydantic path does"""
+
+    def render(self, content) -> bytes:
+        import orjson
+
+        return orjson.dumps(
+            content,
+            option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_UTC_Z
+        )
+
+def shape_document(model, document: dict) -> dict:
+    """Pick ``model`` fields from a trusted DB document without validating them"""
+    shaped = {}
+    for name, field in model.model_fields.items():
+        if name in document:
+            shaped[name] = document[name]
+        else:
+            shaped[name] = None if field.is_required() or field.default_factory else field.default
+    return shaped
+
+def shape_chat(document: dict) -> dict:
+    shaped = shape_document(Chat, document)
+    shaped["messages"] = [shape_document(ChatMessage, message) for message in shaped["messages"]]
+    return shaped
+
+# Keyset pagination
+CHAT_LIST_SORT = [("last_message_at", DESCENDING), ("id", DESCENDING)]
+
+def encode_chat_cursor(chat_data: dict) -> str:
+    """Opaque cursor pointing after the given chat in CHAT_LIST_SORT order"""
+    last_message_at = chat_data["last_message_at"]
+    if isinstance(last_message_at, datetime):
+        last_message_at = last_message_at.isoformat()
+    raw = json.dumps([last_message_at, chat_data["id"]]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def chat_cursor_query(cursor: str) -> dict:
+    """Query selecting the chats that come after ``cursor``"""
     try:
-        # Always regenerate data to ensure fresh token data
-        print("Regenerating test data with tokens...")
-        
-        # Clear existing data
-        await db.chats.delete_many({})
-        await db.deals.delete_many({})
-        print("Cleared existing data")
-        
-        # Clear existing data
-        await db.chats.delete_many({})
-        await db.deals.delete_many({})
-        
-        # Generate test clients and chats
-        clients = []
-        for i in range(50):
-            client_id = str(uuid.uuid4())
-            client_name = f"Клиент {i+1}"
-            client_phone = f"+375{random.randint(29, 44)}{random.randint(1000000, 9999999)}"
-            clients.append((client_id, client_name, client_phone))
-        
-        # Generate chats
-        chats_data = []
-        deals_data = []
-        
-        for client_id, client_name, client_phone in clients:
-            # Determine chat status (now with individual consultation)
-            status_weights = [
-                (ChatStatus.CONSULTATION, 0.35),  # КК - групповые консультации
-                (ChatStatus.INDIVIDUAL_CONSULTATION, 0.25),  # ИК - индивидуальные консультации
-                (ChatStatus.NO_RESPONSE, 0.25),
-                (ChatStatus.ACTIVE, 0.15)
-            ]
-            status = random.choices(
-                [s[0] for s in status_weights],
-                weights=[s[1] for s in status_weights]
-            )[0]
-            
-            # Generate chat with dates spread over last 60 days
-            started_at = datetime.now(timezone.utc) - timedelta(days=random.randint(1, 60))
-            last_message_at = started_at + timedelta(hours=random.randint(1, 48))
-            
-            messages = []
-            total_interactions = random.randint(3, 15)
-            total_tokens_used = 0
-            
-            # Generate messages
-            for j in range(total_interactions):
-                message_time = started_at + timedelta(minutes=j * random.randint(5, 30))
-                sender = "bot" if j % 2 == 0 else "client"
-                
-                if sender == "bot":
-                    bot_messages = [
-                        "Добро пожаловать! Я помогу вам с вопросами по жилищным программам.",
-                        "Расскажите, какие у вас планы по приобретению жилья?",
-                        "Мы предлагаем рассрочку до 15 лет без первоначального взноса.",
-                        "Хотели бы записаться на бесплатную консультацию?",
-                        "Предлагаю записаться на индивидуальную консультацию для детального разбора.",
-                        "Наши специалисты проконсультируют вас по всем вопросам."
-                    ]
-                    message_text = random.choice(bot_messages)
-                    # Бот использует больше токенов для генерации ответов
-                    message_tokens = random.randint(50, 200)
-                else:
-                    client_messages = [
-                        "Здравствуйте!",
-                        "Интересует покупка квартиры в рассрочку",
-                        "Какие условия?",
-                        "Да, хочу записаться на консультацию",
-                        "Лучше индивидуально пообщаться",
-                        "Спасибо за информацию"
-                    ]
-                    message_text = random.choice(client_messages)
-                    # Клиент использует меньше токенов (обработка входящих сообщений)
-                    message_tokens = random.randint(10, 50)
-                
-                total_tokens_used += message_tokens
-                
-                messages.append({
-                    "id": str(uuid.uuid4()),
-                    "timestamp": message_time.isoformat(),
-                    "sender": sender,
-                    "message": message_text,
-                    "tokens_used": message_tokens
+        padded = cursor + "=" * (-len(cursor) % 4)
+        last_message_at, chat_id = json.loads(base64.urlsafe_b64decode(padded))
+        last_message_at = datetime.fromisoformat(last_message_at)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return {"$or": [
+        {"last_message_at": {"$lt": last_message_at}},
+        {"last_message_at": last_message_at, "id": {"$lt": chat_id}}
+    ]}
+
+# Message history windows
+def parse_timestamp(value: str, name: str) -> datetime:
+    """Parse an ISO timestamp query parameter (naive values are UTC)"""
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid {name} timestamp. Use ISO format.")
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+def message_window_condition(variable: str, before: Optional[datetime], after: Optional[datetime]) -> dict:
+    """Aggregation condition keeping messages strictly between ``after`` and ``before``"""
+    conditions = []
+    if before is not None:
+        conditions.append({"$lt": [f"{variable}.timestamp", before]})
+    if after is not None:
+        conditions.append({"$gt": [f"{variable}.timestamp", after]})
+    return {"$and": conditions} if conditions else {"$literal": True}
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, ObjectId):
+        return str(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+# Messages collection storage
+MESSAGE_PROJECTION = {"_id": 0, "chat_id": 0, "client_id": 0}
+
+def message_document(chat: dict, message: dict) -> dict:
+    """Document stored in the messages collection for an embedded-style message"""
+    return {**message, "chat_id": chat["id"], "client_id": chat["client_id"]}
+
+def message_counter_update(messages: list) -> dict:
+    """Atomic counter update applied to a chat when ``messages`` are appended"""
+    return {
+        "$inc": {
+            "total_interactions": len(messages),
+            "total_tokens_used": sum(message.get("tokens_used", 0) for message in messages)
+        },
+        "$max": {"last_message_at": max(message["timestamp"] for message in messages)}
+    }
+
+async def load_chat_messages(chat_id: str, limit: Optional[int] = None) -> list:
+    """All messages of a chat from the messages collection, or only the latest ``limit``"""
+    if not limit:
+        cursor = db.messages.find({"chat_id": chat_id}, MESSAGE_PROJECTION).sort("timestamp", ASCENDING)
+        return await cursor.to_list(length=None)
+    cursor = db.messages.find({"chat_id": chat_id}, MESSAGE_PROJECTION).sort("timestamp", DESCENDING).limit(limit)
+    messages = await cursor.to_list(length=None)
+    messages.reverse()
+    return messages
+
+def merge_messages(embedded: list, stored: list) -> list:
+    """Messages of a chat not fully migrated yet: both sources by timestamp, without duplicates"""
+    merged = {message["id"]: message for message in embedded}
+    merged.update((message["id"], message) for message in stored)
+    return sorted(merged.values(), key=lambda message: message["timestamp"])
+
+async def merge_message_cursors(first, second):
+    """Merge two timestamp-ordered message cursors, skipping messages present in both"""
+    async def next_or_none(cursor):
+        try:
+            return await cursor.__anext__()
+        except StopAsyncIteration:
+            return None
+
+    heads = {}
+    for cursor in (first, second):
+        heads[cursor] = await next_or_none(cursor)
+    last_timestamp, seen_ids = None, set()
+    while any(message is not None for message in heads.values()):
+        cursor = min(
+            (cursor for cursor, message in heads.items() if message is not None),
+            key=lambda cursor: heads[cursor]["timestamp"]
+        )
+        message = heads[cursor]
+        heads[cursor] = await next_or_none(cursor)
+        # Copies of a message share its timestamp, so only ids at the current timestamp are kept
+        if message["timestamp"] != last_timestamp:
+            last_timestamp, seen_ids = message["timestamp"], set()
+        if message["id"] in seen_ids:
+            continue
+        seen_ids.add(message["id"])
+        yield message
+
+async def migrate_messages_to_collection(batch_size: int = 500):
+    """Move embedded chat messages into the messages collection.
+
+    Each chat's messages are inserted (duplicates from an interrupted run
+    are ignored) before the embedded array is removed, so the migration can
+    be stopped and restarted at any time while reads keep working through
+    the dual-read paths.
+    """
+    migrated = 0
+    cursor = db.chats.find({"messages": {"$exists": True}}, {"id": 1, "client_id": 1, "messages": 1})
+    async for chat in cursor.batch_size(batch_size):
+        if chat["messages"]:
+            try:
+                await db.messages.insert_many(
+                    [message_document(chat, message) for message in chat["messages"]],
+                    ordered=False
+                )
+            except BulkWriteError as e:
+                if any(error["code"] != 11000 for error in e.details["writeErrors"]):
+                    raise
+        await db.chats.update_one({"_id": chat["_id"]}, {"$unset": {"messages": ""}})
+        migrated += 1
+
+    if migrated:
+        print(f"Moved messages of {migrated} chats to the messages collection")
+    return migrated
+
+# Date migration
+def _as_datetime(value):
+    if isinstance(value, str):
+        parsed = datetime.fromisoformat(value)
+        return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+    return value
+
+async def migrate_string_dates(batch_size: int = 1000):
+    """Convert ISO string timestamps in chats and deals to native BSON dates.
+
+    Runs online: updates are sent in unordered batches and each one is
+    conditional on the value still being a string. Message timestamps are
+    converted in place with array filters rather than by rewriting the
+    array, so messages pushed meanwhile by ingestion are kept. Safe to run
+    repeatedly and concurrently with reads and writes.
+    """
+    migrations = [
+        (db.chats, ["started_at", "last_message_at"], True),
+        (db.deals, ["created_at", "updated_at"], False)
+    ]
+    migrated = 0
+    for collection, fields, has_messages in migrations:
+        query = {"$or": [{field: {"$type": "string"}} for field in fields]}
+        if has_messages:
+            query["$or"].append({"messages.timestamp": {"$type": "string"}})
+        projection = {field: 1 for field in fields}
+        if has_messages:
+            projection["messages"] = 1
+
+        updates = []
+        async for document in collection.find(query, projection):
+            for field in fields:
+                if isinstance(document.get(field), str):
+                    updates.append(UpdateOne(
+                        {"_id": document["_id"], field: {"$type": "string"}},
+                        {"$set": {field: _as_datetime(document[field])}}
+                    ))
+            if has_messages:
+                # One array filter per distinct string: the conversion only depends on it
+                strings = sorted({
+                    message["timestamp"] for message in document.get("messages") or []
+                    if isinstance(message.get("timestamp"), str)
                 })
-            
-            dialog_cost = random.uniform(5.0, 25.0)  # Cost in BYN
-            
-            chat_data = {
-                "id": str(uuid.uuid4()),
-                "client_id": client_id,
-                "client_name": client_name,
-                "client_phone": client_phone,
-                "status": status.value,
-                "started_at": started_at.isoformat(),
-                "last_message_at": last_message_at.isoformat(),
-                "messages": messages,
-                "total_interactions": total_interactions,
-                "dialog_cost": dialog_cost,
-                "total_tokens_used": total_tokens_used
-            }
-            chats_data.append(chat_data)
-            
-            # Generate deal if appropriate status
-            if status in [ChatStatus.CONSULTATION, ChatStatus.INDIVIDUAL_CONSULTATION, ChatStatus.ACTIVE]:
-                if status == ChatStatus.CONSULTATION:
-                    deal_status = DealStatus.CONSULTATION_SCHEDULED
-                elif status == ChatStatus.INDIVIDUAL_CONSULTATION:
-                    deal_status = DealStatus.INDIVIDUAL_CONSULTATION_SCHEDULED
-                else:
-                    deal_status = random.choice(list(DealStatus))
-                
-                deal_data = {
-                    "id": str(uuid.uuid4()),
-                    "client_id": client_id,
-                    "client_name": client_name,
-                    "status": deal_status.value,
-                    "created_at": started_at.isoformat(),
-                    "updated_at": last_message_at.isoformat(),
-                    "estimated_cost": random.uniform(80000, 300000)  # Cost in BYN
-                }
-                deals_data.append(deal_data)
-        
-        # Insert data
-        if chats_data:
-            await db.chats.insert_many(chats_data)
-        if deals_data:
-            await db.deals.insert_many(deals_data)
-            
-        print(f"Generated {len(chats_data)} chats and {len(deals_data)} deals")
-        
+                if strings:
+                    updates.append(UpdateOne(
+                        {"_id": document["_id"]},
+                        {"$set": {
+                            f"messages.$[m{position}].timestamp": _as_datetime(value)
+                            for position, value in enumerate(strings)
+                        }},
+                        array_filters=[{f"m{position}.timestamp": value} for position, value in enumerate(strings)]
+                    ))
+            if len(updates) >= batch_size:
+                await collection.bulk_write(updates, ordered=False)
+                migrated += len(updates)
+                updates = []
+        if updates:
+            await collection.bulk_write(updates, ordered=False)
+            migrated += len(updates)
+
+    if migrated:
+        print(f"Applied {migrated} updates converting string dates to native dates")
+    return migrated
+
+# Daily rollup
+def day_key(value) -> str:
+    """Rollup key (YYYY-MM-DD, UTC) for a datetime or ISO timestamp string"""
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc)
+    return value.strftime("%Y-%m-%d")
+
+def _day_expression(field: str) -> dict:
+    return {"$dateToString": {"format": "%Y-%m-%d", "date": {"$toDate": f"${field}"}}}
+
+async def rebuild_daily_stats(start_dt: Optional[datetime] = None, end_dt: Optional[datetime] = None):
+    """Rebuild daily_stats from chats and deals.
+
+    Without a period the whole collection is recomputed, otherwise only
+    the days covered by ``start_dt``..``end_dt``. Each day is computed in
+    full by one aggregation and replaces its document in place, so readers
+    never see a day emptied mid-rebuild. Existing days that no longer have
+    data are rewritten as zeroed documents rather than deleted, so
+    overlapping rebuilds cannot remove each other's days.
+    """
+    if start_dt is None or end_dt is None:
+        day_filter = {}
+        chat_filter = {}
+        deal_filter = {}
+    else:
+        start_dt = start_dt.replace(hour=0, minute=0, second=0, microsecond=0)
+        end_dt = end_dt.replace(hour=23, minute=59, second=59, microsecond=999999)
+        day_filter = {"_id": {"$gte": day_key(start_dt), "$lte": day_key(end_dt)}}
+        chat_filter = period_filter("started_at", start_dt, end_dt)
+        deal_filter = period_filter("created_at", start_dt, end_dt)
+
+    pipeline = [
+        {"$match": chat_filter},
+        {"$group": {
+            "_id": {"day": _day_expression("started_at"), "status": "$status"},
+            "count": {"$sum": 1},
+            "total_interactions": {"$sum": "$total_interactions"},
+            "dialog_cost": {"$sum": "$dialog_cost"},
+            "total_tokens_used": {"$sum": "$total_tokens_used"}
+        }},
+        {"$group": {
+            "_id": "$_id.day",
+            "chats": {"$push": {"k": "$_id.status", "v": "$count"}},
+            "chats_total": {"$sum": "$count"},
+            "total_interactions": {"$sum": "$total_interactions"},
+            "dialog_cost": {"$sum": "$dialog_cost"},
+            "total_tokens_used": {"$sum": "$total_tokens_used"}
+        }},
+        {"$set": {"chats": {"$arrayToObject": "$chats"}}},
+        {"$unionWith": {
+            "coll": "deals",
+            "pipeline": [
+                {"$match": deal_filter},
+                {"$group": {
+                    "_id": {"day": _day_expression("created_at"), "status": "$status"},
+                    "count": {"$sum": 1}
+                }},
+                {"$group": {
+                    "_id": "$_id.day",
+                    "deals": {"$push": {"k": "$_id.status", "v": "$count"}},
+                    "deals_total": {"$sum": "$count"}
+                }},
+                {"$set": {"deals": {"$arrayToObject": "$deals"}}}
+            ]
+        }},
+        # Days already in the rollup: without chats or deals they group to zeros
+        {"$unionWith": {
+            "coll": "daily_stats",
+            "pipeline": [{"$match": day_filter}, {"$project": {"_id": 1}}]
+        }},
+        # One complete document per day from its chats and deals halves
+        {"$group": {
+            "_id": "$_id",
+            "chats": {"$mergeObjects": "$chats"},
+            "deals": {"$mergeObjects": "$deals"},
+            "chats_total": {"$sum": "$chats_total"},
+            "total_interactions": {"$sum": "$total_interactions"},
+            "dialog_cost": {"$sum": "$dialog_cost"},
+            "total_tokens_used": {"$sum": "$total_tokens_used"},
+            "deals_total": {"$sum": "$deals_total"}
+        }},
+        {"$set": {"date": "$_id"}},
+        {"$merge": {
+            "into": "daily_stats",
+            "on": "_id",
+            "whenMatched": "replace",
+            "whenNotMatched": "insert"
+        }}
+    ]
+    await db.chats.aggregate(pipeline, allowDiskUse=True).to_list(length=None)
+
+_dirty_days = set()
+_daily_stats_refresh = None
+
+def mark_daily_stats_dirty(days):
+    """Schedule a rebuild of the given rollup days.
+
+    Days are collected for DAILY_STATS_REFRESH_DELAY seconds and then
+    rebuilt once each, so a stream of ingest batches touching the same
+    day costs one rebuild per delay window.
+    """
+    global _daily_stats_refresh
+    _dirty_days.update(days)
+    if _daily_stats_refresh is None or _daily_stats_refresh.done():
+        _daily_stats_refresh = asyncio.ensure_future(_refresh_dirty_days())
+
+async def _refresh_dirty_days():
+    await asyncio.sleep(DAILY_STATS_REFRESH_DELAY)
+    while _dirty_days:
+        day = datetime.strptime(_dirty_days.pop(), "%Y-%m-%d").replace(tzinfo=timezone.utc)
+        try:
+            await rebuild_daily_stats(day, day)
+        except Exception as e:
+            logger.warning(f"Refreshing daily statistics for {day.date()} failed: {str(e)}")
+    invalidate_statistics()
+
+# Generate test data function
+CHAT_STATUS_WEIGHTS = [
+    (ChatStatus.CONSULTATION, 0.35),  # КК - групповые консультации
+    (ChatStatus.INDIVIDUAL_CONSULTATION, 0.25),  # ИК - индивидуальные консультации
+    (ChatStatus.NO_RESPONSE, 0.25),
+    (ChatStatus.ACTIVE, 0.15)
+]
+
+BOT_MESSAGES = [
+    "Добро пожаловать! Я помогу вам с вопросами по жилищным программам.",
+    "Расскажите, какие у вас планы по приобретению жилья?",
+    "Мы предлагаем рассрочку до 15 лет без первоначального взноса.",
+    "Хотели бы записаться на бесплатную консультацию?",
+    "Предлагаю записаться на индивидуальную консультацию для детального разбора.",
+    "Наши специалисты проконсультируют вас по всем вопросам."
+]
+
+CLIENT_MESSAGES = [
+    "Здравствуйте!",
+    "Интересует покупка квартиры в рассрочку",
+    "Какие условия?",
+    "Да, хочу записаться на консультацию",
+    "Лучше индивидуально пообщаться",
+    "Спасибо за информацию"
+]
+
+def _uuid_strings(rng: np.random.Generator, count: int) -> List[str]:
+    raw = rng.bytes(16 * count)
+    return [str(uuid.UUID(bytes=raw[i:i + 16], version=4)) for i in range(0, 16 * count, 16)]
+
+def build_test_chunk(rng: np.random.Generator, first_client: int, count: int,
+                     min_messages: int, max_messages: int):
+    """Build ``count`` test chats and their deals.
+
+    Every random draw (statuses, dates, message counts, tokens, texts) is
+    made with NumPy for the whole chunk at once; only the final documents
+    are assembled in Python.
+    """
+    statuses = [s[0] for s in CHAT_STATUS_WEIGHTS]
+    status_idx = rng.choice(len(statuses), size=count, p=[s[1] for s in CHAT_STATUS_WEIGHTS])
+
+    # Chats start over the last 60 days
+    now = np.datetime64(datetime.now(timezone.utc).replace(tzinfo=None), "ms")
+    started_at = now - rng.integers(1, 61, count).astype("timedelta64[D]")
+    last_message_at = started_at + rng.integers(1, 49, count).astype("timedelta64[h]")
+
+    interactions = rng.integers(min_messages, max_messages + 1, count)
+    total_messages = int(interactions.sum())
+    chat_offsets = np.concatenate(([0], np.cumsum(interactions)[:-1]))
+    # Position of every message inside its chat; bots speak on even positions
+    position = np.arange(total_messages) - np.repeat(chat_offsets, interactions)
+    is_bot = position % 2 == 0
+    message_times = np.repeat(started_at, interactions) + (
+        position * rng.integers(5, 31, total_messages)
+    ).astype("timedelta64[m]")
+    # Бот использует больше токенов для генерации ответов, клиент - меньше
+    tokens = np.where(is_bot, rng.integers(50, 201, total_messages), rng.integers(10, 51, total_messages))
+    chat_tokens = np.add.reduceat(tokens, chat_offsets)
+    text_idx = rng.integers(0, len(BOT_MESSAGES), total_messages)
+
+    dialog_costs = rng.uniform(5.0, 25.0, count)  # Cost in BYN
+    phones = rng.integers(29, 45, count), rng.integers(1000000, 10000000, count)
+    active_deal_idx = rng.integers(0, len(DealStatus), count)
+    estimated_costs = rng.uniform(80000, 300000, count)  # Cost in BYN
+
+    message_ids = _uuid_strings(rng, total_messages)
+    chat_ids = _uuid_strings(rng, count)
+    client_ids = _uuid_strings(rng, count)
+    deal_ids = _uuid_strings(rng, count)
+    message_times = message_times.tolist()
+    started_at = started_at.tolist()
+    last_message_at = last_message_at.tolist()
+    position_senders = ["bot" if bot else "client" for bot in is_bot.tolist()]
+    tokens = tokens.tolist()
+    text_idx = text_idx.tolist()
+    deal_statuses = list(DealStatus)
+
+    chats_data = []
+    deals_data = []
+    for i in range(count):
+        status = statuses[status_idx[i]]
+        client_name = f"Клиент {first_client + i + 1}"
+        client_phone = f"+375{phones[0][i]}{phones[1][i]}"
+
+        offset = int(chat_offsets[i])
+        messages = []
+        for m in range(offset, offset + int(interactions[i])):
+            sender = position_senders[m]
+            messages.append({
+                "id": message_ids[m],
+                "timestamp": message_times[m],
+                "sender": sender,
+                "message": (BOT_MESSAGES if sender == "bot" else CLIENT_MESSAGES)[text_idx[m]],
+                "tokens_used": tokens[m]
+            })
+
+        chats_data.append({
+            "id": chat_ids[i],
+            "client_id": client_ids[i],
+            "client_name": client_name,
+            "client_phone": client_phone,
+            "status": status.value,
+            "started_at": started_at[i],
+            "last_message_at": last_message_at[i],
+            "messages": messages,
+            "total_interactions": int(interactions[i]),
+            "dialog_cost": float(dialog_costs[i]),
+            "total_tokens_used": int(chat_tokens[i]),
+            **chat_search_fields(client_name, client_phone)
+        })
+
+        # Generate deal if appropriate status
+        if status == ChatStatus.NO_RESPONSE:
+            continue
+        if status == ChatStatus.CONSULTATION:
+            deal_status = DealStatus.CONSULTATION_SCHEDULED
+        elif status == ChatStatus.INDIVIDUAL_CONSULTATION:
+            deal_status = DealStatus.INDIVIDUAL_CONSULTATION_SCHEDULED
+        else:
+            deal_status = deal_statuses[active_deal_idx[i]]
+        deals_data.append({
+            "id": deal_ids[i],
+            "client_id": client_ids[i],
+            "client_name": client_name,
+            "status": deal_status.value,
+            "created_at": started_at[i],
+            "updated_at": last_message_at[i],
+            "estimated_cost": float(estimated_costs[i])
+        })
+
+    return chats_data, deals_data
+
+async def insert_test_chunk(chats_data: list, deals_data: list):
+    """Insert one generated chunk with unordered bulk inserts"""
+    inserts = []
+    if CHAT_STORAGE == "collection":
+        # Detach messages before any insert is submitted: Motor encodes the
+        # documents on its executor threads
+        messages = [message_document(chat, message) for chat in chats_data for message in chat.pop("messages")]
+        inserts.append(db.messages.insert_many(messages, ordered=False))
+    inserts.append(db.chats.insert_many(chats_data, ordered=False))
+    if deals_data:
+        inserts.append(db.deals.insert_many(deals_data, ordered=False))
+    await asyncio.gather(*inserts)
+
+async def generate_test_data(
+    num_clients: int = 50,
+    min_messages: int = 3,
+    max_messages: int = 15,
+    wipe: bool = True,
+    chunk_size: int = 5000,
+    concurrency: int = 4,
+    seed: Optional[int] = None
+):
+    """Generate test data for demonstration and load testing.
+
+    Clients are generated in chunks of ``chunk_size``; up to
+    ``concurrency`` chunks are inserted at once, which also bounds how
+    many chunks are held in memory. Raises ValueError for invalid sizes.
+    """
+    if num_clients < 1 or min_messages < 1 or max_messages < min_messages:
+        # Chats without messages would shift np.add.reduceat totals onto other chats
+        raise ValueError("clients and min_messages must be positive and max_messages >= min_messages")
+    if chunk_size < 1 or concurrency < 1:
+        raise ValueError("chunk_size and concurrency must be positive")
+
+    try:
+        rng = np.random.default_rng(seed)
+        print(f"Generating test data for {num_clients} clients...")
+
+        if wipe:
+            # Clear existing data
+            await asyncio.gather(
+                db.chats.delete_many({}),
+                db.deals.delete_many({}),
+                db.messages.delete_many({}),
+                db.daily_stats.delete_many({})
+            )
+            print("Cleared existing data")
+
+        semaphore = asyncio.Semaphore(concurrency)
+        inserts = []
+        chats_count = 0
+        deals_count = 0
+        for first_client in range(0, num_clients, chunk_size):
+            count = min(chunk_size, num_clients - first_client)
+            await semaphore.acquire()
+            # Build off the event loop so the API stays responsive while seeding
+            chats_data, deals_data = await asyncio.to_thread(
+                build_test_chunk, rng, first_client, count, min_messages, max_messages
+            )
+            chats_count += len(chats_data)
+            deals_count += len(deals_data)
+            task = asyncio.ensure_future(insert_test_chunk(chats_data, deals_data))
+            task.add_done_callback(lambda _: semaphore.release())
+            inserts.append(task)
+        await asyncio.gather(*inserts)
+        # Rebuilding is the only way daily_stats is written, so it never races increments
+        try:
+            await rebuild_daily_stats()
+        except Exception as e:
+            logger.warning(f"Rebuilding daily statistics after seeding failed: {str(e)}")
+        invalidate_statistics()
+
+        print(f"Generated {chats_count} chats and {deals_count} deals")
+
     except Exception as e:
         print(f"Error generating test data: {e}")
 
@@ -228,167 +1422,1820 @@ async def generate_test_data():
 async def root():
     return {"message": "Жилищный баланс - Админ панель API"}
 
-@api_router.get("/statistics", response_model=StatisticsResponse)
-async def get_statistics(start_date: Optional[str] = None, end_date: Optional[str] = None):
-    """Get chatbot statistics for date range"""
-    try:
-        # Parse dates or use defaults
-        if start_date and end_date:
-            try:
-                start_dt = datetime.fromisoformat(start_date).replace(tzinfo=timezone.utc)
-                end_dt = datetime.fromisoformat(end_date).replace(tzinfo=timezone.utc)
-            except ValueError:
-                raise HTTPException(status_code=400, detail="Invalid date format. Use ISO format.")
-        else:
-            # Default to last 7 days
-            end_dt = datetime.now(timezone.utc)
-            start_dt = end_dt - timedelta(days=7)
-        
-        # Make POST request to n8n webhook
-        webhook_url = "https://n8n210980.hostkey.in/webhook/gb/statistics/getstatistics"
-        
-        # Prepare request body
-        payload = {
-            "start_date": start_dt.isoformat(),
-            "end_date": end_dt.isoformat()
-        }
-        
+def parse_period(start_date: Optional[str], end_date: Optional[str]):
+    """Parse a statistics period from query parameters (defaults to last 7 days)"""
+    if start_date and end_date:
         try:
-            # Make async HTTP POST request
-            async with httpx.AsyncClient(timeout=30.0) as client:
-                response = await client.post(webhook_url, json=payload)
-                response.raise_for_status()  # Raise exception for 4xx/5xx status codes
-                
-                # Parse response data
-                data = response.json()
-            
-            # Map response fields to StatisticsResponse model
-            return StatisticsResponse(
-                total_deals=data.get("totalDeals", 0),
-                consultation_scheduled=data.get("consultationScheduled", 0),
-                individual_consultation_scheduled=data.get("individualConsultationScheduled", 0),
-                no_response=data.get("noResponse", 0),
-                average_interactions_per_client=round(data.get("averageInteractionsPerClient", 0.0), 2),
-                average_dialog_cost=round(data.get("averageDialogCost", 0.0), 2),
-                average_conversion_cost=round(data.get("averageConversionCost", 0.0), 2),
-                total_tokens_used=data.get("totalTokensUsed", 0),
-                total_period_cost=round(data.get("totalPeriodCost", 0.0), 2),
-                period_start=data.get("periodStart", start_dt.isoformat()),
-                period_end=data.get("periodEnd", end_dt.isoformat())
-            )
-            
-        except httpx.HTTPStatusError as e:
-            # Webhook returned 4xx or 5xx error - return static data
-            logger.warning(f"HTTP error from webhook ({e.response.status_code}), returning static data: {e.response.text}")
-            return StatisticsResponse(
-                total_deals=101,
-                consultation_scheduled=11,
-                individual_consultation_scheduled=10,
-                no_response=11,
-                average_interactions_per_client=11.0,
-                average_dialog_cost=10.01,
-                average_conversion_cost=10.11,
-                total_tokens_used=101011,
-                total_period_cost=111.01,
-                period_start=start_dt.isoformat(),
-                period_end=end_dt.isoformat()
+            start_dt = datetime.fromisoformat(start_date).replace(tzinfo=timezone.utc)
+            end_dt = datetime.fromisoformat(end_date).replace(tzinfo=timezone.utc)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid date format. Use ISO format.")
+    else:
+        # Default to last 7 days, truncated to the minute so repeated
+        # dashboard loads share a cache key
+        end_dt = datetime.now(timezone.utc).replace(second=0, microsecond=0)
+        start_dt = end_dt - timedelta(days=7)
+    return start_dt, end_dt
+
+def static_statistics(start_dt: datetime, end_dt: datetime) -> StatisticsResponse:
+    """Placeholder numbers used when no statistics source is available"""
+    STATISTICS_FALLBACKS.inc(source="static")
+    return StatisticsResponse(
+        total_deals=101,
+        consultation_scheduled=11,
+        individual_consultation_scheduled=10,
+        no_response=11,
+        average_interactions_per_client=11.0,
+        average_dialog_cost=10.01,
+        average_conversion_cost=10.11,
+        total_tokens_used=101011,
+        total_period_cost=111.01,
+        period_start=start_dt.isoformat(),
+        period_end=end_dt.isoformat()
+    )
+
+def period_filter(field: str, start_dt: datetime, end_dt: datetime) -> dict:
+    """Query filter selecting documents whose ``field`` falls inside the period"""
+    return {field: {"$gte": start_dt, "$lte": end_dt}}
+
+async def compute_statistics(start_dt: datetime, end_dt: datetime) -> StatisticsResponse:
+    """Compute period statistics from db.chats and db.deals in a single aggregation.
+
+    Chats are attributed to the period by ``started_at``, deals by ``created_at``.
+    Deals are pulled into the same pipeline with ``$unionWith`` and both
+    collections are summarised side by side with ``$facet``.
+    """
+    period_start = start_dt.isoformat()
+    period_end = end_dt.isoformat()
+
+    pipeline = [
+        {"$match": period_filter("started_at", start_dt, end_dt)},
+        {"$project": {
+            "_id": 0,
+            "kind": "chat",
+            "status": 1,
+            "total_interactions": 1,
+            "dialog_cost": 1,
+            "total_tokens_used": 1
+        }},
+        {"$unionWith": {
+            "coll": "deals",
+            "pipeline": [
+                {"$match": period_filter("created_at", start_dt, end_dt)},
+                {"$project": {"_id": 0, "kind": "deal", "status": 1}}
+            ]
+        }},
+        {"$facet": {
+            "chats": [
+                {"$match": {"kind": "chat"}},
+                {"$group": {
+                    "_id": None,
+                    "count": {"$sum": 1},
+                    "no_response": {"$sum": {"$cond": [
+                        {"$eq": ["$status", ChatStatus.NO_RESPONSE.value]}, 1, 0
+                    ]}},
+                    "avg_interactions": {"$avg": "$total_interactions"},
+                    "avg_dialog_cost": {"$avg": "$dialog_cost"},
+                    "total_tokens_used": {"$sum": "$total_tokens_used"},
+                    "total_cost": {"$sum": "$dialog_cost"}
+                }}
+            ],
+            "deals": [
+                {"$match": {"kind": "deal"}},
+                {"$group": {"_id": "$status", "count": {"$sum": 1}}}
+            ]
+        }}
+    ]
+
+    with timed("mongo_aggregate"):
+        result = await analytics_db.chats.aggregate(pipeline, maxTimeMS=MONGO_MAX_TIME_MS).to_list(length=1)
+    facets = result[0] if result else {"chats": [], "deals": []}
+    chats = facets["chats"][0] if facets["chats"] else {}
+    deals_by_status = {row["_id"]: row["count"] for row in facets["deals"]}
+
+    consultation_scheduled = deals_by_status.get(DealStatus.CONSULTATION_SCHEDULED.value, 0)
+    individual_consultation_scheduled = deals_by_status.get(
+        DealStatus.INDIVIDUAL_CONSULTATION_SCHEDULED.value, 0
+    )
+    conversions = consultation_scheduled + individual_consultation_scheduled
+    total_cost = chats.get("total_cost") or 0.0
+
+    return StatisticsResponse(
+        total_deals=sum(deals_by_status.values()),
+        consultation_scheduled=consultation_scheduled,
+        individual_consultation_scheduled=individual_consultation_scheduled,
+        no_response=chats.get("no_response", 0),
+        average_interactions_per_client=round(chats.get("avg_interactions") or 0.0, 2),
+        average_dialog_cost=round(chats.get("avg_dialog_cost") or 0.0, 2),
+        average_conversion_cost=round(total_cost / conversions, 2) if conversions else 0.0,
+        total_tokens_used=chats.get("total_tokens_used", 0),
+        total_period_cost=round(total_cost, 2),
+        period_start=period_start,
+        period_end=period_end
+    )
+
+async def compute_statistics_from_rollup(start_dt: datetime, end_dt: datetime) -> StatisticsResponse:
+    """Compute period statistics by summing daily_stats documents.
+
+    The rollup has day granularity: every day touched by the period is
+    counted in full.
+    """
+    with timed("mongo_find"):
+        days = await analytics_db.daily_stats.find(
+            {"_id": {"$gte": day_key(start_dt), "$lte": day_key(end_dt)}}
+        ).max_time_ms(MONGO_MAX_TIME_MS).to_list(length=None)
+
+    chats_total = sum(d.get("chats_total", 0) for d in days)
+    total_interactions = sum(d.get("total_interactions", 0) for d in days)
+    total_cost = sum(d.get("dialog_cost", 0.0) for d in days)
+    total_tokens_used = sum(d.get("total_tokens_used", 0) for d in days)
+
+    def chat_count(status: ChatStatus) -> int:
+        return sum(d.get("chats", {}).get(status.value, 0) for d in days)
+
+    def deal_count(status: DealStatus) -> int:
+        return sum(d.get("deals", {}).get(status.value, 0) for d in days)
+
+    consultation_scheduled = deal_count(DealStatus.CONSULTATION_SCHEDULED)
+    individual_consultation_scheduled = deal_count(DealStatus.INDIVIDUAL_CONSULTATION_SCHEDULED)
+    conversions = consultation_scheduled + individual_consultation_scheduled
+
+    return StatisticsResponse(
+        total_deals=sum(d.get("deals_total", 0) for d in days),
+        consultation_scheduled=consultation_scheduled,
+        individual_consultation_scheduled=individual_consultation_scheduled,
+        no_response=chat_count(ChatStatus.NO_RESPONSE),
+        average_interactions_per_client=round(total_interactions / chats_total, 2) if chats_total else 0.0,
+        average_dialog_cost=round(total_cost / chats_total, 2) if chats_total else 0.0,
+        average_conversion_cost=round(total_cost / conversions, 2) if conversions else 0.0,
+        total_tokens_used=total_tokens_used,
+        total_period_cost=round(total_cost, 2),
+        period_start=start_dt.isoformat(),
+        period_end=end_dt.isoformat()
+    )
+
+async def fetch_webhook_statistics(start_dt: datetime, end_dt: datetime) -> StatisticsResponse:
+    """Fetch period statistics from the n8n webhook"""
+    # Prepare request body
+    payload = {
+        "start_date": start_dt.isoformat(),
+        "end_date": end_dt.isoformat()
+    }
+
+    # Raises for 4xx/5xx status codes and CircuitOpenError while n8n is unhealthy
+    with timed("webhook_call"):
+        response = await statistics_webhook_breaker.call(
+            lambda timeout: webhook_request(
+                "POST",
+                "/webhook/gb/statistics/getstatistics",
+                json=payload,
+                timeout=httpx.Timeout(timeout, connect=min(timeout, HTTP_CONNECT_TIMEOUT))
             )
-            
-        except httpx.RequestError as e:
-            # Network error or timeout - return static data
-            logger.warning(f"Request error to webhook, returning static data: {str(e)}")
-            return StatisticsResponse(
-                total_deals=101,
-                consultation_scheduled=11,
-                individual_consultation_scheduled=10,
-                no_response=11,
-                average_interactions_per_client=11.0,
-                average_dialog_cost=10.01,
-                average_conversion_cost=10.11,
-                total_tokens_used=101011,
-                total_period_cost=111.01,
-                period_start=start_dt.isoformat(),
-                period_end=end_dt.isoformat()
+        )
+    data = response.json()
+
+    # Map response fields to StatisticsResponse model
+    return StatisticsResponse(
+        total_deals=data.get("totalDeals", 0),
+        consultation_scheduled=data.get("consultationScheduled", 0),
+        individual_consultation_scheduled=data.get("individualConsultationScheduled", 0),
+        no_response=data.get("noResponse", 0),
+        average_interactions_per_client=round(data.get("averageInteractionsPerClient", 0.0), 2),
+        average_dialog_cost=round(data.get("averageDialogCost", 0.0), 2),
+        average_conversion_cost=round(data.get("averageConversionCost", 0.0), 2),
+        total_tokens_used=data.get("totalTokensUsed", 0),
+        total_period_cost=round(data.get("totalPeriodCost", 0.0), 2),
+        period_start=data.get("periodStart", start_dt.isoformat()),
+        period_end=data.get("periodEnd", end_dt.isoformat())
+    )
+
+def statistics_engine(start_dt: datetime, end_dt: datetime):
+    if STATISTICS_ENGINE == "rollup":
+        return compute_statistics_from_rollup(start_dt, end_dt)
+    return compute_statistics(start_dt, end_dt)
+
+async def load_statistics(start_dt: datetime, end_dt: datetime):
+    """Load statistics from the configured sources in order, then static data.
+
+    Returns ``(source, statistics)`` where source is "mongo", "webhook" or
+    "static".
+
+    By default statistics are computed locally with the webhook as an
+    optional fallback; STATISTICS_SOURCE=webhook reverses the order. Results
+    are cached per source; static placeholder responses are not. While the
+    webhook circuit breaker is open the webhook is skipped immediately.
+    """
+    mongo_source = ("mongo", statistics_engine)
+    webhook_source = ("webhook", fetch_webhook_statistics)
+    if STATISTICS_SOURCE == "webhook":
+        sources = [webhook_source, mongo_source]
+    elif STATISTICS_WEBHOOK_FALLBACK:
+        sources = [mongo_source, webhook_source]
+    else:
+        sources = [mongo_source]
+
+    key = (start_dt.isoformat(), end_dt.isoformat())
+    for position, (name, source) in enumerate(sources):
+        if position:
+            STATISTICS_FALLBACKS.inc(source=name)
+        try:
+            return name, await statistics_cache.get_or_load(
+                (name,) + key,
+                lambda source=source: source(start_dt, end_dt)
             )
-        
+        except CircuitOpenError as e:
+            logger.info(f"Skipping statistics source {name}: {str(e)}")
+        except httpx.HTTPStatusError as e:
+            logger.warning(f"HTTP error from webhook ({e.response.status_code}): {e.response.text}")
+        except Exception as e:
+            logger.warning(f"Statistics source {name} failed: {str(e)}")
+
+    return "static", static_statistics(start_dt, end_dt)
+
+# Conditional GET
+def compute_etag(*parts) -> str:
+    """Strong ETag over JSON-serializable parts"""
+    payload = json.dumps(parts, default=_json_default, sort_keys=True, separators=(",", ":"))
+    return '"' + hashlib.sha1(payload.encode("utf-8")).hexdigest() + '"'
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """Whether the request's If-None-Match already names ``etag``"""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    for candidate in header.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate in ("*", etag):
+            return True
+    return False
+
+def etag_headers(etag: str) -> Dict[str, str]:
+    # Browsers may keep the response but must revalidate before reusing it
+    return {"ETag": etag, "Cache-Control": "no-cache"}
+
+@api_router.get("/statistics", response_model=StatisticsResponse)
+async def get_statistics(
+    request: Request,
+    response: Response,
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None
+):
+    """Get chatbot statistics for date range.
+
+    Answers 304 Not Modified when If-None-Match carries the current ETag.
+    X-Statistics-Source tells which source served the numbers.
+    """
+    try:
+        start_dt, end_dt = parse_period(start_date, end_date)
+        source, statistics = await load_statistics(start_dt, end_dt)
+        headers = {**etag_headers(compute_etag(statistics.model_dump(mode="json"))), "X-Statistics-Source": source}
+        if etag_matches(request, headers["ETag"]):
+            return Response(status_code=304, headers=headers)
+        response.headers.update(headers)
+        return statistics
+
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Unexpected error getting statistics: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error getting statistics: {str(e)}")
 
+# Time series
+TIMESERIES_UNITS = {
+    "hour": timedelta(hours=1),
+    "day": timedelta(days=1),
+    "week": timedelta(weeks=1)
+}
+CONVERSION_STATUSES = (DealStatus.CONSULTATION_SCHEDULED.value, DealStatus.INDIVIDUAL_CONSULTATION_SCHEDULED.value)
+
+def truncate_to_bucket(value: datetime, unit: str) -> datetime:
+    """Start of the UTC bucket containing ``value`` (weeks start on Monday)"""
+    value = value.astimezone(timezone.utc).replace(minute=0, second=0, microsecond=0)
+    if unit == "hour":
+        return value
+    value = value.replace(hour=0)
+    if unit == "week":
+        value -= timedelta(days=value.weekday())
+    return value
+
+async def compute_timeseries_buckets(start_dt: datetime, end_dt: datetime, unit: str) -> Dict[str, TimeseriesBucket]:
+    """Aggregate chats, messages and deals of the period into buckets with $dateTrunc.
+
+    New chats count in the bucket they started in. Tokens count in the
+    bucket of each message's timestamp, and a chat's dialog_cost is spread
+    over its messages in proportion to their tokens, so long conversations
+    show their spend when it happened.
+    """
+    def bucket_of(field: str) -> dict:
+        return {"$dateTrunc": {"date": f"${field}", "unit": unit, "startOfWeek": "monday"}}
+
+    # Chat cost per token, as both message sources need it
+    cost_per_token = {"$cond": [
+        {"$gt": ["$total_tokens_used", 0]},
+        {"$divide": ["$dialog_cost", "$total_tokens_used"]},
+        0
+    ]}
+    # Embedded messages: only chats whose lifetime overlaps the period
+    embedded_tokens = [
+        {"$match": {"last_message_at": {"$gte": start_dt}, "started_at": {"$lte": end_dt}}},
+        {"$project": {
+            "cost_per_token": cost_per_token,
+            "messages": {"$filter": {
+                "input": {"$ifNull": ["$messages", []]},
+                "as": "m",
+                "cond": {"$and": [{"$gte": ["$$m.timestamp", start_dt]}, {"$lte": ["$$m.timestamp", end_dt]}]}
+            }}
+        }},
+        {"$unwind": "$messages"},
+        {"$group": {
+            "_id": {"kind": "tokens", "start": bucket_of("messages.timestamp")},
+            "tokens": {"$sum": "$messages.tokens_used"},
+            "cost": {"$sum": {"$multiply": ["$messages.tokens_used", "$cost_per_token"]}}
+        }}
+    ]
+    pipeline = [
+        {"$match": period_filter("started_at", start_dt, end_dt)},
+        {"$group": {
+            "_id": {"kind": "chat", "start": bucket_of("started_at"), "status": "$status"},
+            "count": {"$sum": 1}
+        }},
+        {"$unionWith": {"coll": "chats", "pipeline": embedded_tokens}}
+    ]
+    if CHAT_STORAGE == "collection":
+        pipeline.append({"$unionWith": {
+            "coll": "messages",
+            "pipeline": [
+                {"$match": period_filter("timestamp", start_dt, end_dt)},
+                {"$group": {
+                    "_id": {"client_id": "$client_id", "start": bucket_of("timestamp")},
+                    "tokens": {"$sum": "$tokens_used"}
+                }},
+                {"$lookup": {
+                    "from": "chats",
+                    "localField": "_id.client_id",
+                    "foreignField": "client_id",
+                    "pipeline": [{"$project": {"_id": 0, "cost_per_token": cost_per_token}}],
+                    "as": "chat"
+                }},
+                {"$group": {
+                    "_id": {"kind": "tokens", "start": "$_id.start"},
+                    "tokens": {"$sum": "$tokens"},
+                    "cost": {"$sum": {"$multiply": [
+                        "$tokens", {"$ifNull": [{"$first": "$chat.cost_per_token"}, 0]}
+                    ]}}
+                }}
+            ]
+        }})
+    pipeline += [
+        {"$unionWith": {
+            "coll": "deals",
+            "pipeline": [
+                {"$match": period_filter("created_at", start_dt, end_dt)},
+                {"$group": {
+                    "_id": {"kind": "deal", "start": bucket_of("created_at"), "status": "$status"},
+                    "count": {"$sum": 1}
+                }}
+            ]
+        }}
+    ]
+    buckets = {}
+    with timed("mongo_aggregate"):
+        rows = await analytics_db.chats.aggregate(pipeline, maxTimeMS=MONGO_MAX_TIME_MS).to_list(length=None)
+    for row in rows:
+        start = row["_id"]["start"]
+        bucket = buckets.setdefault(start.isoformat(), TimeseriesBucket(start=start))
+        status = row["_id"].get("status")
+        if row["_id"]["kind"] == "chat":
+            bucket.new_chats += row["count"]
+            bucket.chats_by_status[status] = row["count"]
+        elif row["_id"]["kind"] == "tokens":
+            bucket.total_tokens_used += row["tokens"]
+            bucket.total_cost = round(bucket.total_cost + row["cost"], 2)
+        else:
+            bucket.deals_by_status[status] = row["count"]
+            if status in CONVERSION_STATUSES:
+                bucket.conversions += row["count"]
+    return buckets
+
+@api_router.get("/statistics/timeseries", response_model=TimeseriesResponse)
+async def get_statistics_timeseries(
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    bucket: str = "day"
+):
+    """Get tokens, cost, new chats and conversions per hour, day or week.
+
+    New chats are bucketed by ``started_at``, tokens and cost by message
+    ``timestamp`` and deals by ``created_at`` (UTC). Buckets that are fully inside the period and already over are cached
+    for TIMESERIES_CACHE_TTL seconds, so mostly the still-open tail of the period is aggregated again.
+    """
+    try:
+        if bucket not in TIMESERIES_UNITS:
+            raise HTTPException(status_code=400, detail="Invalid bucket. Use hour, day or week.")
+        start_dt, end_dt = parse_period(start_date, end_date)
+        step = TIMESERIES_UNITS[bucket]
+        if (end_dt - start_dt) / step > TIMESERIES_MAX_BUCKETS:
+            raise HTTPException(status_code=400, detail=f"Period too long: at most {TIMESERIES_MAX_BUCKETS} buckets")
+
+        now = datetime.now(timezone.utc)
+        starts = []
+        current = truncate_to_bucket(start_dt, bucket)
+        while current <= end_dt:
+            starts.append(current)
+            current += step
+
+        def cacheable(start: datetime) -> bool:
+            end = start + step
+            # Buckets are half-open: one ending right after end_dt is still inside the period
+            return start >= start_dt and end - timedelta(microseconds=1) <= end_dt and end <= now
+
+        cached = {start: cached_timeseries_bucket((bucket, start.isoformat())) for start in starts}
+        # Aggregate only the runs of consecutive buckets that are not cached
+        # (typically a partial first bucket and the still-open tail)
+        runs = []
+        for start in starts:
+            if cached[start] is not None:
+                continue
+            if runs and runs[-1][1] == start:
+                runs[-1][1] = start + step
+            else:
+                runs.append([start, start + step])
+        computed = {}
+        for partial in await asyncio.gather(*(
+            compute_timeseries_buckets(max(start_dt, run_start), min(end_dt, run_end - timedelta(microseconds=1)), bucket)
+            for run_start, run_end in runs
+        )):
+            computed.update(partial)
+
+        buckets = []
+        for start in starts:
+            if cached[start] is not None:
+                buckets.append(cached[start])
+                continue
+            value = computed.get(start.isoformat()) or TimeseriesBucket(start=start)
+            if cacheable(start):
+                timeseries_cache[(bucket, start.isoformat())] = (value, time.monotonic())
+                while len(timeseries_cache) > TIMESERIES_CACHE_SIZE:
+                    timeseries_cache.popitem(last=False)
+            buckets.append(value)
+
+        return TimeseriesResponse(
+            bucket=bucket,
+            period_start=start_dt.isoformat(),
+            period_end=end_dt.isoformat(),
+            buckets=buckets
+        )
+
+    except HTTPException:
+        raise
+    except ExecutionTimeout:
+        raise HTTPException(status_code=503, detail="Time series query took too long, shorten the period")
+    except Exception as e:
+        logger.error(f"Unexpected error getting statistics timeseries: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error getting statistics timeseries: {str(e)}")
+
+@api_router.get("/statistics/cache")
+async def get_statistics_cache_stats():
+    """Get statistics cache hit/miss counters"""
+    return statistics_cache.stats()
+
 @api_router.get("/chats", response_model=ChatListResponse)
-async def get_chats(limit: int = 20, offset: int = 0, search: Optional[str] = None):
-    """Get chat history with pagination and search"""
+async def get_chats(
+    request: Request,
+    response: Response,
+    limit: int = Query(20, ge=1, le=500),
+    offset: int = Query(0, ge=0),
+    search: Optional[str] = None,
+    after: Optional[str] = None,
+    include_total: bool = True
+):
+    """Get chat history with pagination and search.
+
+    Pages can be requested by ``offset`` or, at constant cost, by passing
+    the previous page's ``next_cursor`` as ``after``. The ETag covers the
+    page's chat headers and the total, so an unchanged page answers 304
+    before any models are built.
+    """
     try:
         # Build query
-        query = {}
-        if search:
-            query = {
-                "$or": [
-                    {"client_name": {"$regex": search, "$options": "i"}},
-                    {"client_phone": {"$regex": search, "$options": "i"}}
-                ]
-            }
-        
-        # Get total count
-        total = await db.chats.count_documents(query)
-        
-        # Get chats with pagination
-        chats_cursor = db.chats.find(query).sort("last_message_at", -1).skip(offset).limit(limit)
-        chats_data = await chats_cursor.to_list(length=None)
-        
-        # Convert to Chat models
-        chats = []
-        for chat_data in chats_data:
-            # Convert datetime strings back to datetime objects for response
-            chat_data["started_at"] = datetime.fromisoformat(chat_data["started_at"])
-            chat_data["last_message_at"] = datetime.fromisoformat(chat_data["last_message_at"])
-            
-            # Convert message timestamps
-            for message in chat_data.get("messages", []):
-                message["timestamp"] = datetime.fromisoformat(message["timestamp"])
-            
-            chats.append(Chat(**chat_data))
-        
-        return ChatListResponse(chats=chats, total=total)
-        
+        query = build_chat_search_query(search) if search else {}
+
+        # Get total count (estimated from collection metadata when unfiltered)
+        total = None
+        if include_total:
+            with timed("mongo_count"):
+                if query:
+                    total = await list_db.chats.count_documents(query, maxTimeMS=MONGO_MAX_TIME_MS)
+                else:
+                    total = await list_db.chats.estimated_document_count()
+
+        # Keyset pagination replaces skip when a cursor is given
+        if after:
+            query = {"$and": [query, chat_cursor_query(after)]} if query else chat_cursor_query(after)
+            offset = 0
+
+        # Fetch one extra chat to know whether another page exists
+        chats_cursor = list_db.chats.find(query, CHAT_SUMMARY_PROJECTION).sort(CHAT_LIST_SORT).skip(offset).limit(
+            limit + 1
+        ).max_time_ms(MONGO_MAX_TIME_MS)
+        with timed("mongo_find"):
+            chats_data = await chats_cursor.to_list(length=None)
+        next_cursor = None
+        if len(chats_data) > limit:
+            chats_data = chats_data[:limit]
+            next_cursor = encode_chat_cursor(chats_data[-1])
+
+        # Cheap validator instead of hashing the whole page: chat updates arrive
+        # with a message, which moves the chat up and advances last_message_at
+        etag = compute_etag(
+            [chat_data["id"] for chat_data in chats_data],
+            max((chat_data["last_message_at"] for chat_data in chats_data), default=None),
+            total,
+            next_cursor
+        )
+        if etag_matches(request, etag):
+            return Response(status_code=304, headers=etag_headers(etag))
+
+        with timed("model_construction"):
+            if FAST_JSON_RESPONSES:
+                return FastJSONResponse({
+                    "chats": [shape_document(ChatSummary, chat_data) for chat_data in chats_data],
+                    "total": total,
+                    "next_cursor": next_cursor
+                }, headers=etag_headers(etag))
+
+            # Convert to ChatSummary models (dates are decoded by the driver)
+            chats = [ChatSummary(**chat_data) for chat_data in chats_data]
+
+        response.headers.update(etag_headers(etag))
+        return ChatListResponse(chats=chats, total=total, next_cursor=next_cursor)
+
+    except HTTPException:
+        raise
+    except ExecutionTimeout:
+        raise HTTPException(status_code=503, detail="Chat query took too long, narrow the search")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error getting chats: {e}")
 
+async def load_batch_messages(chats: List[dict], limit: Optional[int]):
+    """Fill ``messages`` of chats from the messages collection.
+
+    Chats that still embed messages (not migrated yet) get both sources merged.
+    """
+    def fill(chat: dict, stored: list):
+        if "messages" in chat:
+            messages = merge_messages(chat["messages"], stored)
+            chat["messages"] = messages[-limit:] if limit else messages
+        else:
+            chat["messages"] = stored
+
+    chat_ids = [chat["id"] for chat in chats]
+    if limit:
+        # One indexed query per chat, run concurrently, to read only the tail
+        windows = await asyncio.gather(*(load_chat_messages(chat_id, limit) for chat_id in chat_ids))
+        for chat, messages in zip(chats, windows):
+            fill(chat, messages)
+        return
+
+    by_chat = {chat_id: [] for chat_id in chat_ids}
+    cursor = db.messages.find({"chat_id": {"$in": chat_ids}}, {"_id": 0, "client_id": 0}).sort(
+        [("chat_id", ASCENDING), ("timestamp", ASCENDING)]
+    )
+    async for message in cursor:
+        by_chat[message.pop("chat_id")].append(message)
+    for chat in chats:
+        fill(chat, by_chat[chat["id"]])
+
+@api_router.post("/chats/batch", response_model=ChatBatchResponse)
+async def get_chats_batch(request: ChatBatchRequest):
+    """Get several chats by client_id with a single ``$in`` query.
+
+    Headers only by default; ``include_messages`` adds the history, or just
+    the latest ``messages_limit`` messages. Chats come back in the order of
+    ``client_ids`` and unknown ids are listed in ``missing``.
+    """
+    try:
+        client_ids = list(dict.fromkeys(request.client_ids))
+        if len(client_ids) > CHATS_BATCH_MAX_IDS:
+            raise HTTPException(status_code=413, detail=f"At most {CHATS_BATCH_MAX_IDS} chats per batch")
+
+        if not request.include_messages:
+            projection = CHAT_SUMMARY_PROJECTION
+        elif request.messages_limit:
+            projection = {"_id": 0, "name_tokens": 0, "phone_digits": 0,
+                          "messages": {"$slice": -request.messages_limit}}
+        else:
+            projection = {"_id": 0, "name_tokens": 0, "phone_digits": 0}
+        with timed("mongo_find"):
+            found = {
+                chat["client_id"]: chat
+                async for chat in db.chats.find({"client_id": {"$in": client_ids}}, projection)
+            }
+
+        chats_data = [found[client_id] for client_id in client_ids if client_id in found]
+        missing = [client_id for client_id in client_ids if client_id not in found]
+        if request.include_messages:
+            # Chats stored with the messages collection, or partly so while not migrated yet
+            pending = chats_data if CHAT_STORAGE == "collection" else [
+                chat for chat in chats_data if "messages" not in chat
+            ]
+            if pending:
+                with timed("mongo_find"):
+                    await load_batch_messages(pending, request.messages_limit)
+
+        with timed("model_construction"):
+            if FAST_JSON_RESPONSES:
+                return FastJSONResponse({
+                    "chats": [
+                        shape_chat(chat_data) if request.include_messages else shape_document(ChatBatchEntry, chat_data)
+                        for chat_data in chats_data
+                    ],
+                    "missing": missing
+                })
+
+            chats = [ChatBatchEntry(**chat_data) for chat_data in chats_data]
+
+        return ChatBatchResponse(chats=chats, missing=missing)
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error getting chats batch: {e}")
+
 @api_router.get("/chats/{owner_id}")
-async def get_chat_details(owner_id: str):
-    """Get detailed chat information"""
+async def get_chat_details(owner_id: str, messages_limit: Optional[int] = Query(None, ge=1)):
+    """Get detailed chat information.
+
+    ``messages_limit`` keeps only the latest N messages; use
+    /chats/{owner_id}/messages to page through the rest.
+    """
     try:
-        chat_data = await db.chats.find_one({"client_id": owner_id})
+        projection = {"messages": {"$slice": -messages_limit}} if messages_limit else None
+        with timed("mongo_find"):
+            chat_data = await db.chats.find_one({"client_id": owner_id}, projection)
         if not chat_data:
             raise HTTPException(status_code=404, detail="Chat not found")
-        
-        # Convert datetime strings back to datetime objects
-        chat_data["started_at"] = datetime.fromisoformat(chat_data["started_at"])
-        chat_data["last_message_at"] = datetime.fromisoformat(chat_data["last_message_at"])
-        
-        # Convert message timestamps
-        for message in chat_data.get("messages", []):
-            message["timestamp"] = datetime.fromisoformat(message["timestamp"])
-        
-        return Chat(**chat_data)
+        if "messages" not in chat_data:
+            # Chat stored with the messages collection
+            with timed("mongo_find"):
+                chat_data["messages"] = await load_chat_messages(chat_data["id"], messages_limit)
+        elif CHAT_STORAGE == "collection":
+            # Not migrated yet: messages ingested since live in the collection
+            with timed("mongo_find"):
+                stored = await load_chat_messages(chat_data["id"], messages_limit)
+            messages = merge_messages(chat_data["messages"], stored)
+            chat_data["messages"] = messages[-messages_limit:] if messages_limit else messages
+
+        with timed("model_construction"):
+            if FAST_JSON_RESPONSES:
+                return FastJSONResponse(shape_chat(chat_data))
+
+            return Chat(**chat_data)
         
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error getting chat details: {e}")
 
+@api_router.get("/chats/{owner_id}/messages", response_model=MessageWindowResponse)
+async def get_chat_messages(
+    owner_id: str,
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+    limit: int = Query(50, ge=1),
+    format: str = "json"
+):
+    """Get a window of chat messages.
+
+    By default returns the latest ``limit`` messages older than ``before``.
+    With ``after`` only, returns the first ``limit`` messages newer than it.
+    ``format=ndjson`` streams every message in the window, one JSON object
+    per line, without loading the transcript into memory.
+    """
+    try:
+        before_dt = parse_timestamp(before, "before") if before else None
+        after_dt = parse_timestamp(after, "after") if after else None
+
+        chat = await db.chats.find_one(
+            {"client_id": owner_id},
+            {"_id": 0, "id": 1, "embedded": {"$isArray": "$messages"}}
+        )
+        if not chat:
+            raise HTTPException(status_code=404, detail="Chat not found")
+
+        if format == "ndjson":
+            return StreamingResponse(
+                stream_chat_messages(owner_id, chat, before_dt, after_dt),
+                media_type="application/x-ndjson",
+                headers={"Content-Disposition": f'attachment; filename="chat-{owner_id}.ndjson"'}
+            )
+        if format != "json":
+            raise HTTPException(status_code=400, detail="Unsupported format. Use json or ndjson.")
+
+        limit = max(1, min(limit, 500))
+        # Page forward from `after` when only it is given, otherwise backwards
+        forward = after_dt is not None and before_dt is None
+        if not chat["embedded"]:
+            window, has_more = await message_window_from_collection(chat["id"], before_dt, after_dt, limit, forward)
+            result = [{"messages": window, "has_more": has_more}]
+        else:
+            result = await embedded_message_window(owner_id, before_dt, after_dt, limit, forward)
+            if result and CHAT_STORAGE == "collection":
+                # Not migrated yet: merge in messages ingested into the collection since
+                window, has_more = await message_window_from_collection(chat["id"], before_dt, after_dt, limit, forward)
+                messages = merge_messages(result[0]["messages"], window)
+                result = [{
+                    "messages": messages[:limit] if forward else messages[-limit:],
+                    "has_more": has_more or result[0]["has_more"] or len(messages) > limit
+                }]
+        if not result:
+            raise HTTPException(status_code=404, detail="Chat not found")
+
+        if FAST_JSON_RESPONSES:
+            return FastJSONResponse({
+                "messages": [shape_document(ChatMessage, message) for message in result[0]["messages"]],
+                "has_more": result[0]["has_more"]
+            })
+
+        messages = [ChatMessage(**message) for message in result[0]["messages"]]
+        return MessageWindowResponse(messages=messages, has_more=result[0]["has_more"])
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error getting chat messages: {e}")
+
+async def embedded_message_window(owner_id: str, before: Optional[datetime], after: Optional[datetime],
+                                  limit: int, forward: bool) -> list:
+    pipeline = [
+        {"$match": {"client_id": owner_id}},
+        {"$project": {
+            "_id": 0,
+            "window": {"$filter": {
+                "input": {"$ifNull": ["$messages", []]},
+                "as": "m",
+                "cond": message_window_condition("$$m", before, after)
+            }}
+        }},
+        {"$project": {
+            "has_more": {"$gt": [{"$size": "$window"}, limit]},
+            "messages": {"$slice": ["$window", limit] if forward else ["$window", -limit]}
+        }}
+    ]
+    return await db.chats.aggregate(pipeline).to_list(length=1)
+
+def _timestamp_range(before: Optional[datetime], after: Optional[datetime]) -> dict:
+    timestamp = {}
+    if before is not None:
+        timestamp["$lt"] = before
+    if after is not None:
+        timestamp["$gt"] = after
+    return {"timestamp": timestamp} if timestamp else {}
+
+async def message_window_from_collection(chat_id: str, before: Optional[datetime], after: Optional[datetime],
+                                         limit: int, forward: bool):
+    query = {"chat_id": chat_id, **_timestamp_range(before, after)}
+    cursor = db.messages.find(query, MESSAGE_PROJECTION).sort(
+        "timestamp", ASCENDING if forward else DESCENDING
+    ).limit(limit + 1)
+    messages = await cursor.to_list(length=None)
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+    if not forward:
+        messages.reverse()
+    return messages, has_more
+
+async def stream_chat_messages(owner_id: str, chat: dict, before: Optional[datetime], after: Optional[datetime]):
+    """Yield NDJSON lines for a chat transcript straight from Mongo cursors"""
+    query = {"chat_id": chat["id"], **_timestamp_range(before, after)}
+    cursor = db.messages.find(query, MESSAGE_PROJECTION).sort("timestamp", ASCENDING).batch_size(500)
+    if chat["embedded"]:
+        pipeline = [
+            {"$match": {"client_id": owner_id}},
+            {"$unwind": "$messages"},
+            {"$replaceRoot": {"newRoot": "$messages"}},
+            {"$match": {"$expr": message_window_condition("$$ROOT", before, after)}},
+            {"$sort": {"timestamp": 1}}
+        ]
+        embedded = db.chats.aggregate(pipeline, batchSize=500)
+        # Not migrated yet: messages ingested since live in the collection
+        cursor = merge_message_cursors(embedded, cursor) if CHAT_STORAGE == "collection" else embedded
+    async for message in cursor:
+        yield json.dumps(message, ensure_ascii=False, default=_json_default) + "\n"
+
 @api_router.post("/generate-test-data")
-async def generate_test_data_endpoint():
+async def generate_test_data_endpoint(
+    clients: int = 50,
+    min_messages: int = 3,
+    max_messages: int = 15,
+    wipe: bool = True
+):
     """Generate test data for demonstration"""
     try:
-        await generate_test_data()
+        await generate_test_data(clients, min_messages, max_messages, wipe=wipe)
         return {"message": "Test data generated successfully"}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error generating test data: {e}")
 
+@api_router.post("/daily-stats/rebuild")
+async def rebuild_daily_stats_endpoint(start_date: Optional[str] = None, end_date: Optional[str] = None):
+    """Rebuild the daily_stats rollup (whole history, or only the given period)"""
+    try:
+        if start_date or end_date:
+            start_dt, end_dt = parse_period(start_date, end_date)
+            await rebuild_daily_stats(start_dt, end_dt)
+        else:
+            await rebuild_daily_stats()
+        invalidate_statistics()
+        return {"message": "Daily statistics rebuilt successfully"}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error rebuilding daily statistics: {e}")
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus metrics"""
+    for cache in (statistics_cache, webhook_cache):
+        stats = cache.stats()
+        for event in ("hits", "stale_hits", "misses", "coalesced", "refresh_errors"):
+            CACHE_EVENTS.set(stats[event], cache=cache.name, event=event)
+    for breaker in (statistics_webhook_breaker,):
+        stats = breaker.stats()
+        CIRCUIT_STATE.set({"closed": 0, "half_open": 1, "open": 2}[stats["state"]], breaker=breaker.name)
+        CIRCUIT_TIMEOUT.set(stats["timeout"], breaker=breaker.name)
+        CIRCUIT_SHORT_CIRCUITS.set(stats["short_circuited"], breaker=breaker.name)
+
+    lines = []
+    for metric in (REQUEST_DURATION, STAGE_DURATION, STATISTICS_FALLBACKS, CACHE_EVENTS,
+                   MONGO_POOL, MONGO_POOL_CHECKOUT_FAILURES, CIRCUIT_STATE, CIRCUIT_TIMEOUT,
+                   CIRCUIT_SHORT_CIRCUITS, REQUESTS_REJECTED, EXPENSIVE_IN_FLIGHT):
+        lines += metric.render()
+    return PlainTextResponse("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
+
+class CompressionMiddleware:
+    """Compress responses of known length with brotli or gzip.
+
+    Responses with a Content-Length between ``minimum_size`` and
+    ``maximum_size`` are buffered (even when sent in several chunks) and
+    compressed; streaming responses (SSE, NDJSON, exports) have no
+    Content-Length and pass through untouched so events are never held
+    back in a compressor buffer.
+    """
+
+    def __init__(self, app, minimum_size: int = 1024, maximum_size: int = 8 * 1024 * 1024):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.maximum_size = maximum_size
+
+    @staticmethod
+    def choose_encoding(accept_encoding: str) -> Optional[str]:
+        accepted = set()
+        for item in accept_encoding.split(","):
+            coding, _, params = item.partition(";")
+            quality = params.strip()
+            if quality.startswith("q="):
+                try:
+                    if float(quality[2:]) <= 0:
+                        continue
+                except ValueError:
+                    continue
+            accepted.add(coding.strip().lower())
+        if BROTLI_AVAILABLE and "br" in accepted:
+            return "br"
+        if "gzip" in accepted:
+            return "gzip"
+        return None
+
+    def compress(self, body: bytes, encoding: str) -> bytes:
+        if encoding == "br":
+            import brotli
+
+            return brotli.compress(body, quality=COMPRESSION_BROTLI_QUALITY)
+        return gzip.compress(body, compresslevel=COMPRESSION_GZIP_LEVEL)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or self.minimum_size <= 0:
+            await self.app(scope, receive, send)
+            return
+        encoding = self.choose_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        pending_start = None
+        chunks = []
+
+        async def send_compressed(message):
+            nonlocal pending_start
+            if message["type"] == "http.response.start":
+                headers = Headers(raw=message["headers"])
+                length = headers.get("content-length")
+                if (
+                    length is not None
+                    and self.minimum_size <= int(length) <= self.maximum_size
+                    and "content-encoding" not in headers
+                ):
+                    pending_start = message
+                    return
+            elif message["type"] == "http.response.body" and pending_start is not None:
+                chunks.append(message.get("body", b""))
+                if message.get("more_body", False):
+                    return
+                start, pending_start = pending_start, None
+                body = self.compress(b"".join(chunks), encoding)
+                headers = MutableHeaders(raw=start["headers"])
+                headers["Content-Encoding"] = encoding
+                headers["Content-Length"] = str(len(body))
+                headers.add_vary_header("Accept-Encoding")
+                await send(start)
+                await send({"type": "http.response.body", "body": body})
+                return
+            await send(message)
+
+        await self.app(scope, receive, send_compressed)
+
+class RequestMetricsMiddleware:
+    """Record time to response headers per method, route and status.
+
+    Plain ASGI rather than ``@app.middleware`` so response bodies reach
+    the outer middleware (compression) exactly as the route sent them.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    def observe(self, scope, started: float, status: int):
+        route = scope.get("route")
+        REQUEST_DURATION.observe(
+            time.perf_counter() - started,
+            method=scope["method"],
+            route=route.path if route is not None else "unmatched",
+            status=status
+        )
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        observed = False
+
+        async def send_observed(message):
+            nonlocal observed
+            if message["type"] == "http.response.start" and not observed:
+                observed = True
+                self.observe(scope, started, message["status"])
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_observed)
+        finally:
+            if not observed:
+                self.observe(scope, started, 500)
+
+# n8n webhook proxy
+async def _fetch_webhook(path: str):
+    response = await webhook_request("GET", path)
+    return response.content, response.headers.get("content-type", "application/json")
+
+async def proxy_webhook_read(path: str) -> Response:
+    """Proxy a GET webhook through the short-TTL cache (concurrent reads are coalesced)"""
+    try:
+        content, media_type = await webhook_cache.get_or_load(path, lambda: _fetch_webhook(path))
+        return Response(content=content, media_type=media_type)
+    except httpx.HTTPStatusError as e:
+        raise HTTPException(status_code=e.response.status_code, detail=f"Webhook error: {e.response.text}")
+    except httpx.TimeoutException as e:
+        raise HTTPException(status_code=504, detail=f"Webhook timeout: {e}")
+    except httpx.RequestError as e:
+        raise HTTPException(status_code=502, detail=f"Webhook unavailable: {e}")
+
+async def proxy_webhook_write(path: str, request: Request, invalidates: str) -> Response:
+    """Forward a POST to a webhook and drop the cached read it changes"""
+    try:
+        response = await webhook_request(
+            "POST",
+            path,
+            content=await request.body(),
+            headers={"content-type": request.headers.get("content-type", "application/json")}
+        )
+        webhook_cache.invalidate(invalidates)
+        return Response(
+            content=response.content,
+            media_type=response.headers.get("content-type", "application/json")
+        )
+    except httpx.HTTPStatusError as e:
+        raise HTTPException(status_code=e.response.status_code, detail=f"Webhook error: {e.response.text}")
+    except httpx.TimeoutException as e:
+        raise HTTPException(status_code=504, detail=f"Webhook timeout: {e}")
+    except httpx.RequestError as e:
+        raise HTTPException(status_code=502, detail=f"Webhook unavailable: {e}")
+
+@api_router.get("/schedule")
+async def get_schedule():
+    """Get the bot schedule (proxied from n8n)"""
+    return await proxy_webhook_read("/webhook/gb/schedule")
+
+@api_router.post("/schedule")
+async def save_schedule(request: Request):
+    """Save the bot schedule (proxied to n8n)"""
+    return await proxy_webhook_write("/webhook/gb/schedule", request, invalidates="/webhook/gb/schedule")
+
+@api_router.get("/togglebot/status")
+async def get_bot_status():
+    """Get the bot on/off status (proxied from n8n)"""
+    return await proxy_webhook_read("/webhook/gb/togglebot/status")
+
+@api_router.post("/togglebot/toggle")
+async def toggle_bot(request: Request):
+    """Switch the bot on or off (proxied to n8n)"""
+    return await proxy_webhook_write("/webhook/gb/togglebot/toggle", request, invalidates="/webhook/gb/togglebot/status")
+
+@api_router.get("/mailing/config")
+async def get_mailing_config():
+    """Get the mailing settings (proxied from n8n)"""
+    return await proxy_webhook_read("/webhook/gb/mailing/config")
+
+@api_router.post("/mailing/config")
+async def save_mailing_config(request: Request):
+    """Save the mailing settings, including an uploaded contacts file (proxied to n8n)"""
+    return await proxy_webhook_write("/webhook/gb/mailing/config", request, invalidates="/webhook/gb/mailing/config")
+
+# Live feed
+class ChangeFeedHub:
+    """Fan out one MongoDB change stream on chats and deals to SSE subscribers.
+
+    The stream is opened when the first admin connects and closed when the
+    last one leaves. Every subscriber has a bounded queue; a subscriber
+    that falls behind has its backlog replaced by a single ``resync`` event
+    telling the UI to re-fetch, so a slow client never blocks the others.
+    """
+
+    WATCHED_COLLECTIONS = ["chats", "deals", "messages"]
+    # ChangeStreamFatalError, CappedPositionLost, ChangeStreamHistoryLost:
+    # the resume token points past the oplog window
+    RESUME_LOST_CODES = {280, 136, 286}
+
+    def __init__(self, queue_size: int):
+        self.queue_size = queue_size
+        self._subscribers = set()
+        self._task = None
+        self._resume_token = None
+
+    def subscribe(self) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        self._subscribers.add(queue)
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        self._subscribers.discard(queue)
+        if not self._subscribers:
+            self.stop()
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        # Admins connecting later load fresh state; replaying the gap would only force a resync
+        self._resume_token = None
+
+    def publish(self, event: dict):
+        for queue in self._subscribers:
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait({"type": "resync"})
+
+    async def _run(self):
+        pipeline = [
+            {"$match": {
+                "ns.coll": {"$in": self.WATCHED_COLLECTIONS},
+                # Deletes carry only the Mongo _id, which the UI cannot map to a
+                # chat or deal; the test-data wipe is the only path deleting them
+                "operationType": {"$in": ["insert", "update", "replace"]}
+            }},
+            {"$project": {
+                "fullDocument.messages": 0,
+                "fullDocument.name_tokens": 0,
+                "fullDocument.phone_digits": 0
+            }}
+        ]
+        retry_delay = 1.0
+        while True:
+            try:
+                async with db.watch(
+                    pipeline,
+                    full_document="updateLookup",
+                    resume_after=self._resume_token
+                ) as stream:
+                    retry_delay = 1.0
+                    async for change in stream:
+                        self._resume_token = stream.resume_token
+                        self.publish(change_event(change))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if (
+                    isinstance(e, OperationFailure)
+                    and e.code in self.RESUME_LOST_CODES
+                    and self._resume_token is not None
+                ):
+                    # Changes since the token are gone: start a fresh stream and let the UI re-fetch
+                    logger.warning(f"Change stream history lost, starting a new stream: {str(e)}")
+                    self._resume_token = None
+                    self.publish({"type": "resync"})
+                    continue
+                logger.warning(f"Change stream failed, retrying in {retry_delay}s: {str(e)}")
+                self.publish({"type": "error", "detail": str(e)})
+                await asyncio.sleep(retry_delay)
+                retry_delay = min(retry_delay * 2, 60.0)
+
+def change_event(change: dict) -> dict:
+    """Turn a change stream document into a compact delta for the admin UI"""
+    document = change.get("fullDocument") or {}
+    document.pop("_id", None)
+    event = {
+        "type": change["operationType"],
+        "collection": change["ns"]["coll"],
+        "id": document.get("id"),
+        "client_id": document.get("client_id")
+    }
+    if change["operationType"] in ("insert", "replace"):
+        event["document"] = document
+    elif change["operationType"] == "update":
+        description = change.get("updateDescription", {})
+        changes = {}
+        new_messages = []
+        for field, value in description.get("updatedFields", {}).items():
+            if field.startswith("messages."):
+                new_messages.append(value)
+            elif field == "messages":
+                changes["messages_replaced"] = True
+            elif field not in ("name_tokens", "phone_digits"):
+                changes[field] = value
+        event["changes"] = changes
+        if new_messages:
+            event["messages"] = new_messages
+        if description.get("removedFields"):
+            event["removed"] = description["removedFields"]
+    return event
+
+change_feed = ChangeFeedHub(EVENTS_QUEUE_SIZE)
+
+@api_router.get("/events")
+async def stream_events(request: Request):
+    """Server-Sent Events feed of new chats, messages, status changes and deals"""
+    queue = change_feed.subscribe()
+
+    async def events():
+        try:
+            yield "retry: 5000\n\n"
+            while not await request.is_disconnected():
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=EVENTS_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                data = json.dumps(event, ensure_ascii=False, default=_json_default)
+                yield f"event: {event['type']}\ndata: {data}\n\n"
+        finally:
+            change_feed.unsubscribe(queue)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+# Ingestion
+def parse_ingest_events(body: bytes, content_type: str):
+    """Parse a JSON array (or single object) or NDJSON body into raw events"""
+    if "ndjson" in content_type or "jsonlines" in content_type:
+        return [json.loads(line) for line in body.splitlines() if line.strip()]
+    events = json.loads(body)
+    return events if isinstance(events, list) else [events]
+
+def chat_header_upsert(client_id: str, events: List[IngestMessageEvent]) -> UpdateOne:
+    """Create the chat on first contact and apply the latest header fields"""
+    first_seen = min(event.message.timestamp for event in events)
+    latest = {}
+    for event in events:
+        for field in ("client_name", "client_phone", "status"):
+            if getattr(event, field) is not None:
+                latest[field] = getattr(event, field)
+
+    on_insert = {
+        "id": str(uuid.uuid4()),
+        "started_at": first_seen,
+        "last_message_at": first_seen,
+        "total_interactions": 0,
+        "dialog_cost": 0.0,
+        "total_tokens_used": 0
+    }
+    if CHAT_STORAGE != "collection":
+        on_insert["messages"] = []
+    defaults = {"client_name": "", "client_phone": "", "status": ChatStatus.ACTIVE}
+    for field, default in defaults.items():
+        if field not in latest:
+            on_insert[field] = default.value if isinstance(default, ChatStatus) else default
+
+    to_set = {field: value.value if isinstance(value, ChatStatus) else value for field, value in latest.items()}
+    if "client_name" in latest and "client_phone" in latest:
+        to_set.update(chat_search_fields(latest["client_name"], latest["client_phone"]))
+    elif "client_name" in latest:
+        to_set["name_tokens"] = chat_search_fields(latest["client_name"], "")["name_tokens"]
+        on_insert["phone_digits"] = ""
+    elif "client_phone" in latest:
+        to_set["phone_digits"] = chat_search_fields("", latest["client_phone"])["phone_digits"]
+        on_insert["name_tokens"] = []
+    else:
+        on_insert.update(chat_search_fields("", ""))
+
+    update = {"$setOnInsert": on_insert}
+    if to_set:
+        update["$set"] = to_set
+    return UpdateOne({"client_id": client_id}, update, upsert=True)
+
+def _only_duplicate_key_errors(error: BulkWriteError) -> bool:
+    return all(write_error["code"] == 11000 for write_error in error.details["writeErrors"])
+
+async def ingest_messages(events: List[IngestMessageEvent]):
+    """Apply message events to chats, idempotently on message id.
+
+    Chat headers are upserted first, then every message is appended with
+    its counter increments. A message whose id is already stored is
+    skipped, so retried batches are safe. Returns (accepted, duplicates).
+    """
+    by_client = {}
+    for event in events:
+        by_client.setdefault(event.client_id, []).append(event)
+    header_ops = [chat_header_upsert(client_id, client_events) for client_id, client_events in by_client.items()]
+
+    if CHAT_STORAGE == "collection":
+        return await _ingest_messages_to_collection(events, by_client, header_ops)
+
+    message_ops = []
+    for event in events:
+        message = event.message.model_dump()
+        update = message_counter_update([message])
+        update["$inc"]["dialog_cost"] = event.dialog_cost
+        update["$push"] = {"messages": message}
+        message_ops.append(UpdateOne(
+            {"client_id": event.client_id, "messages.id": {"$ne": message["id"]}},
+            update
+        ))
+
+    # One ordered bulk write: headers before messages. A concurrent request
+    # creating the same chat aborts it at a header, before any message was
+    # applied, so it is simply retried.
+    for attempt in range(2):
+        try:
+            result = await db.chats.bulk_write(header_ops + message_ops, ordered=True)
+            break
+        except BulkWriteError as e:
+            if attempt or not _only_duplicate_key_errors(e):
+                raise
+    # Headers that matched an existing chat also count as matched
+    accepted = result.matched_count - (len(header_ops) - result.upserted_count)
+    return accepted, len(message_ops) - accepted
+
+async def _ingest_messages_to_collection(events: List[IngestMessageEvent], by_client: dict, header_ops: list):
+    try:
+        await db.chats.bulk_write(header_ops, ordered=False)
+    except BulkWriteError as e:
+        # Chats created concurrently by another request already exist
+        if not _only_duplicate_key_errors(e):
+            raise
+    chats = {
+        chat["client_id"]: chat
+        async for chat in db.chats.find({"client_id": {"$in": list(by_client)}}, {"_id": 0, "id": 1, "client_id": 1})
+    }
+
+    # The unique index on messages.id filters out duplicates
+    duplicates = set()
+    try:
+        await db.messages.insert_many(
+            [message_document(chats[event.client_id], event.message.model_dump()) for event in events],
+            ordered=False
+        )
+    except BulkWriteError as e:
+        if not _only_duplicate_key_errors(e):
+            raise
+        duplicates = {write_error["index"] for write_error in e.details["writeErrors"]}
+
+    accepted_by_client = {}
+    for index, event in enumerate(events):
+        if index not in duplicates:
+            accepted_by_client.setdefault(event.client_id, []).append(event)
+    counter_ops = []
+    for client_id, client_events in accepted_by_client.items():
+        update = message_counter_update([event.message.model_dump() for event in client_events])
+        update["$inc"]["dialog_cost"] = sum(event.dialog_cost for event in client_events)
+        counter_ops.append(UpdateOne({"client_id": client_id}, update))
+    if counter_ops:
+        await db.chats.bulk_write(counter_ops, ordered=False)
+    return len(events) - len(duplicates), len(duplicates)
+
+async def ingest_deals(events: List[IngestDealEvent]) -> int:
+    """Upsert deal events with one unordered bulk write on deals"""
+    now = datetime.now(timezone.utc)
+    ops = [
+        UpdateOne(
+            {"id": event.id},
+            {
+                "$set": {
+                    "client_id": event.client_id,
+                    "client_name": event.client_name,
+                    "status": event.status.value,
+                    "estimated_cost": event.estimated_cost,
+                    "updated_at": event.updated_at or now
+                },
+                "$setOnInsert": {"created_at": event.created_at or now}
+            },
+            upsert=True
+        )
+        for event in events
+    ]
+    if ops:
+        await db.deals.bulk_write(ops, ordered=False)
+    return len(ops)
+
+@api_router.post("/ingest", response_model=IngestResponse)
+async def ingest_events(request: Request):
+    """Ingest a batch of bot message and deal events.
+
+    Accepts a JSON array or NDJSON (``application/x-ndjson``). Invalid
+    events are reported in ``rejected`` and do not stop the batch.
+    """
+    try:
+        raw_events = parse_ingest_events(await request.body(), request.headers.get("content-type", ""))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid request body: {e}")
+    if len(raw_events) > INGEST_MAX_EVENTS:
+        raise HTTPException(status_code=413, detail=f"At most {INGEST_MAX_EVENTS} events per batch")
+
+    messages = []
+    deals = []
+    rejected = []
+    for index, raw in enumerate(raw_events):
+        try:
+            kind = raw.get("type") if isinstance(raw, dict) else None
+            if kind == "message":
+                messages.append(IngestMessageEvent(**raw))
+            elif kind == "deal":
+                deals.append(IngestDealEvent(**raw))
+            else:
+                rejected.append({"index": index, "error": "Unknown event type"})
+        except ValidationError as e:
+            rejected.append({"index": index, "error": str(e)})
+
+    try:
+        accepted, duplicates = await ingest_messages(messages) if messages else (0, 0)
+        deals_count = await ingest_deals(deals)
+
+        # Refresh the rollup days touched by this batch
+        days = set()
+        if messages:
+            cursor = db.chats.find({"client_id": {"$in": list({e.client_id for e in messages})}}, {"started_at": 1})
+            days.update([day_key(chat["started_at"]) async for chat in cursor])
+        if deals:
+            cursor = db.deals.find({"id": {"$in": [e.id for e in deals]}}, {"created_at": 1})
+            days.update([day_key(deal["created_at"]) async for deal in cursor])
+        if days:
+            mark_daily_stats_dirty(days)
+
+        return IngestResponse(
+            accepted_messages=accepted,
+            duplicate_messages=duplicates,
+            deals=deals_count,
+            rejected=rejected
+        )
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error ingesting events: {e}")
+
+# Export
+CHAT_EXPORT_COLUMNS = [
+    ("id", "string"),
+    ("client_id", "string"),
+    ("client_name", "string"),
+    ("client_phone", "string"),
+    ("status", "string"),
+    ("started_at", "datetime"),
+    ("last_message_at", "datetime"),
+    ("total_interactions", "int"),
+    ("dialog_cost", "float"),
+    ("total_tokens_used", "int")
+]
+MESSAGE_EXPORT_COLUMNS = CHAT_EXPORT_COLUMNS + [
+    ("message_id", "string"),
+    ("message_timestamp", "datetime"),
+    ("sender", "string"),
+    ("message", "string"),
+    ("tokens_used", "int")
+]
+DEAL_EXPORT_COLUMNS = [
+    ("id", "string"),
+    ("client_id", "string"),
+    ("client_name", "string"),
+    ("status", "string"),
+    ("created_at", "datetime"),
+    ("updated_at", "datetime"),
+    ("estimated_cost", "float")
+]
+
+class _ParquetStreamSink:
+    """Write-only file object that hands written bytes back in chunks.
+
+    Tracks its own position so the Parquet footer offsets stay correct
+    even though the buffer is drained after every row group.
+    """
+
+    def __init__(self):
+        self._buffer = io.BytesIO()
+        self._position = 0
+        self.closed = False
+
+    def write(self, data) -> int:
+        self._buffer.write(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data = self._buffer.getvalue()
+        self._buffer = io.BytesIO()
+        return data
+
+def export_filter(field: str, start_date: Optional[str], end_date: Optional[str], status: Optional[str]) -> dict:
+    query = {}
+    period = {}
+    if start_date:
+        period["$gte"] = parse_timestamp(start_date, "start_date")
+    if end_date:
+        period["$lte"] = parse_timestamp(end_date, "end_date")
+    if period:
+        query[field] = period
+    if status:
+        query["status"] = {"$in": status.split(",")}
+    return query
+
+async def _batched(cursor, size: int):
+    batch = []
+    async for document in cursor:
+        batch.append(document)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+async def stream_csv(cursor, columns):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow([name for name, _ in columns])
+    yield buffer.getvalue().encode("utf-8-sig")
+    async for batch in _batched(cursor, EXPORT_BATCH_SIZE):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for row in batch:
+            writer.writerow([
+                value.isoformat() if isinstance(value, datetime) else value
+                for value in (row.get(name) for name, _ in columns)
+            ])
+        yield buffer.getvalue().encode("utf-8")
+
+async def stream_parquet(cursor, columns):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    types = {
+        "string": pa.string(),
+        "datetime": pa.timestamp("ms", tz="UTC"),
+        "int": pa.int64(),
+        "float": pa.float64()
+    }
+    schema = pa.schema([(name, types[kind]) for name, kind in columns])
+    sink = _ParquetStreamSink()
+    writer = pq.ParquetWriter(pa.PythonFile(sink, mode="w"), schema)
+    async for batch in _batched(cursor, EXPORT_BATCH_SIZE):
+        rows = [{name: row.get(name) for name, _ in columns} for row in batch]
+        writer.write_table(pa.Table.from_pylist(rows, schema=schema))
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+def export_response(cursor, columns, format: str, name: str) -> StreamingResponse:
+    if format == "csv":
+        return StreamingResponse(
+            stream_csv(cursor, columns),
+            media_type="text/csv; charset=utf-8",
+            headers={"Content-Disposition": f'attachment; filename="{name}.csv"'}
+        )
+    if format == "parquet":
+        if importlib.util.find_spec("pyarrow") is None:
+            raise HTTPException(status_code=400, detail="Parquet export requires the pyarrow package")
+        return StreamingResponse(
+            stream_parquet(cursor, columns),
+            media_type="application/vnd.apache.parquet",
+            headers={"Content-Disposition": f'attachment; filename="{name}.parquet"'}
+        )
+    raise HTTPException(status_code=400, detail="Unsupported format. Use csv or parquet.")
+
+@api_router.get("/export/chats")
+async def export_chats(
+    format: str = "csv",
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    status: Optional[str] = None,
+    flatten_messages: bool = False
+):
+    """Stream chats as CSV or Parquet.
+
+    Filters on ``started_at`` and a comma-separated ``status`` list. With
+    ``flatten_messages`` every message becomes its own row, repeating the
+    chat columns. In collection mode rows from not yet migrated chats
+    come first, then the messages collection one batch of chats at a time.
+    """
+    query = export_filter("started_at", start_date, end_date, status)
+    projection = {"_id": 0, **{name: 1 for name, _ in CHAT_EXPORT_COLUMNS}}
+    if not flatten_messages:
+        cursor = analytics_db.chats.find(query, projection).sort("started_at", ASCENDING).batch_size(EXPORT_BATCH_SIZE)
+        if MONGO_EXPORT_MAX_TIME_MS:
+            cursor = cursor.max_time_ms(int(MONGO_EXPORT_MAX_TIME_MS))
+        return export_response(cursor, CHAT_EXPORT_COLUMNS, format, "chats")
+
+    # In collection mode this pass only covers chats not migrated yet
+    embedded_query = {"$and": [query, {"messages": {"$exists": True}}]} if CHAT_STORAGE == "collection" else query
+    pipeline = [
+        {"$match": embedded_query},
+        {"$sort": {"started_at": 1}},
+        {"$unwind": "$messages"},
+        {"$project": {
+            **projection,
+            "message_id": "$messages.id",
+            "message_timestamp": "$messages.timestamp",
+            "sender": "$messages.sender",
+            "message": "$messages.message",
+            "tokens_used": "$messages.tokens_used"
+        }}
+    ]
+    options = {"maxTimeMS": int(MONGO_EXPORT_MAX_TIME_MS)} if MONGO_EXPORT_MAX_TIME_MS else {}
+    cursor = analytics_db.chats.aggregate(pipeline, batchSize=EXPORT_BATCH_SIZE, allowDiskUse=True, **options)
+    if CHAT_STORAGE == "collection":
+        cursor = _chain(cursor, stored_message_rows(query, projection))
+    return export_response(cursor, MESSAGE_EXPORT_COLUMNS, format, "chat_messages")
+
+async def _chain(*cursors):
+    for cursor in cursors:
+        async for document in cursor:
+            yield document
+
+async def stored_message_rows(query: dict, projection: dict):
+    """Flattened export rows for messages in the messages collection.
+
+    Chat headers are read in batches; each batch's messages are streamed
+    from one query sorted on the (chat_id, timestamp) index and joined to
+    their header, so memory stays bounded by the batch however long the
+    conversations are.
+    """
+    # Ids still embedded in a chat caught mid-migration were exported by the first pass
+    headers = analytics_db.chats.find(query, {**projection, "id": 1, "messages.id": 1})
+    async for batch in _batched(headers.sort("started_at", ASCENDING).batch_size(EXPORT_BATCH_SIZE), EXPORT_BATCH_SIZE):
+        by_id = {chat["id"]: chat for chat in batch}
+        embedded_ids = {
+            chat["id"]: {message.get("id") for message in chat.pop("messages", None) or []} for chat in batch
+        }
+        messages = analytics_db.messages.find(
+            {"chat_id": {"$in": list(by_id)}}, {"_id": 0, "client_id": 0}
+        ).sort([("chat_id", ASCENDING), ("timestamp", ASCENDING)]).batch_size(EXPORT_BATCH_SIZE)
+        if MONGO_EXPORT_MAX_TIME_MS:
+            messages = messages.max_time_ms(int(MONGO_EXPORT_MAX_TIME_MS))
+        async for message in messages:
+            if message.get("id") in embedded_ids[message["chat_id"]]:
+                continue
+            yield {
+                **by_id[message["chat_id"]],
+                "message_id": message.get("id"),
+                "message_timestamp": message.get("timestamp"),
+                "sender": message.get("sender"),
+                "message": message.get("message"),
+                "tokens_used": message.get("tokens_used")
+            }
+
+@api_router.get("/export/deals")
+async def export_deals(
+    format: str = "csv",
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    status: Optional[str] = None
+):
+    """Stream deals as CSV or Parquet, filtered on ``created_at`` and status"""
+    query = export_filter("created_at", start_date, end_date, status)
+    projection = {"_id": 0, **{name: 1 for name, _ in DEAL_EXPORT_COLUMNS}}
+    cursor = analytics_db.deals.find(query, projection).sort("created_at", ASCENDING).batch_size(EXPORT_BATCH_SIZE)
+    if MONGO_EXPORT_MAX_TIME_MS:
+        cursor = cursor.max_time_ms(int(MONGO_EXPORT_MAX_TIME_MS))
+    return export_response(cursor, DEAL_EXPORT_COLUMNS, format, "deals")
+
+# Admission control
+class TokenBucketLimiter:
+    """In-memory token buckets, one per key, local to this worker"""
+
+    def __init__(self, max_keys: int = 10000):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+
+    async def acquire(self, key: str, rate: float, burst: float) -> float:
+        """Take one token; returns 0 when allowed, else seconds until a token is available"""
+        now = time.monotonic()
+        tokens, updated = self._buckets.pop(key, (burst, now))
+        tokens = min(burst, tokens + (now - updated) * rate)
+        retry_after = 0.0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            retry_after = (1 - tokens) / rate
+        self._buckets[key] = (tokens, now)
+        while len(self._buckets) > self.max_keys:
+            # Forgetting the idlest bucket only refills it early
+            self._buckets.popitem(last=False)
+        return retry_after
+
+class MongoTokenBucketLimiter:
+    """Token buckets in the rate_limits collection, shared by all workers.
+
+    Refill and take happen in one atomic pipeline update per request. If
+    Mongo is unavailable the worker falls back to its in-memory buckets
+    rather than rejecting or blocking traffic.
+    """
+
+    def __init__(self, collection, fallback: TokenBucketLimiter):
+        self.collection = collection
+        self.fallback = fallback
+
+    async def acquire(self, key: str, rate: float, burst: float) -> float:
+        now = datetime.now(timezone.utc)
+        elapsed = {"$max": [0, {"$divide": [{"$subtract": [now, {"$ifNull": ["$updated_at", now]}]}, 1000]}]}
+        pipeline = [
+            {"$set": {
+                "tokens": {"$min": [burst, {"$add": [{"$ifNull": ["$tokens", burst]}, {"$multiply": [elapsed, rate]}]}]},
+                "updated_at": now
+            }},
+            {"$set": {"allowed": {"$gte": ["$tokens", 1]}}},
+            {"$set": {
+                "tokens": {"$cond": ["$allowed", {"$subtract": ["$tokens", 1]}, "$tokens"]},
+                "expires_at": now + timedelta(seconds=burst / rate + 60)
+            }}
+        ]
+        for attempt in range(2):
+            try:
+                bucket = await self.collection.find_one_and_update(
+                    {"_id": key}, pipeline, upsert=True, return_document=ReturnDocument.AFTER
+                )
+                break
+            except DuplicateKeyError:
+                # Another worker created the bucket first; update it instead
+                if attempt:
+                    return 0.0
+            except Exception as e:
+                logger.warning(f"Shared rate limit unavailable, using local buckets: {str(e)}")
+                return await self.fallback.acquire(key, rate, burst)
+        if bucket["allowed"]:
+            return 0.0
+        return (1 - bucket["tokens"]) / rate
+
+rate_limiter = TokenBucketLimiter()
+if RATE_LIMIT_STORAGE == "mongo":
+    rate_limiter = MongoTokenBucketLimiter(db.rate_limits, rate_limiter)
+expensive_pool = asyncio.Semaphore(EXPENSIVE_CONCURRENCY)
+EXPENSIVE_ROUTES = {"/api/generate-test-data", "/api/daily-stats/rebuild", "/api/export/chats", "/api/export/deals"}
+
+def is_expensive(route: str, params) -> bool:
+    """Whether a request should run in the bounded pool for expensive work"""
+    if route in EXPENSIVE_ROUTES:
+        return True
+    if route == "/api/chats":
+        try:
+            return int(params.get("offset") or 0) > EXPENSIVE_CHATS_OFFSET
+        except ValueError:
+            return False
+    if route in ("/api/statistics", "/api/statistics/timeseries"):
+        try:
+            start_dt, end_dt = parse_period(params.get("start_date"), params.get("end_date"))
+        except HTTPException:
+            # The route itself answers 400
+            return False
+        return (end_dt - start_dt) > timedelta(days=EXPENSIVE_PERIOD_DAYS)
+    return False
+
+class AdmissionControlMiddleware:
+    """Rate-limit API requests per route and client, and bound expensive work.
+
+    Every request takes a token from its IP address's bucket; a request
+    carrying an X-Client-Id header must also get one from that client's
+    bucket, so the header can narrow a limit but never escape the IP one.
+    Expensive requests (see is_expensive) get a tighter bucket and hold a
+    slot of a small shared pool until their response is fully sent, so
+    exports and wide aggregations cannot starve cheap dashboard reads.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    @staticmethod
+    def route_path(scope) -> str:
+        for route in app.router.routes:
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                return route.path
+        return "unmatched"
+
+    @staticmethod
+    def client_keys(scope) -> List[str]:
+        headers = Headers(scope=scope)
+        forwarded = headers.get("x-forwarded-for")
+        if RATE_LIMIT_TRUST_PROXY and forwarded:
+            keys = [f"ip:{forwarded.split(',')[0].strip()}"]
+        else:
+            client = scope.get("client")
+            keys = [f"ip:{client[0] if client else 'unknown'}"]
+        client_id = headers.get("x-client-id")
+        if client_id:
+            keys.append(f"id:{client_id}")
+        return keys
+
+    async def reject(self, scope, receive, send, status_code: int, detail: str, retry_after: float):
+        response = JSONResponse(
+            {"detail": detail},
+            status_code=status_code,
+            headers={"Retry-After": str(max(1, int(retry_after + 0.999)))}
+        )
+        await response(scope, receive, send)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not scope["path"].startswith("/api"):
+            await self.app(scope, receive, send)
+            return
+        route = self.route_path(scope)
+        if route in RATE_LIMIT_EXEMPT_ROUTES:
+            await self.app(scope, receive, send)
+            return
+        expensive = is_expensive(route, Request(scope).query_params)
+
+        if RATE_LIMIT_ENABLED:
+            rate, burst = RATE_LIMIT_RATE, RATE_LIMIT_BURST
+            if expensive:
+                rate, burst = RATE_LIMIT_EXPENSIVE_RATE, RATE_LIMIT_EXPENSIVE_BURST
+            tier = "expensive" if expensive else "default"
+            retry_after = 0.0
+            for key in self.client_keys(scope):
+                retry_after = max(retry_after, await rate_limiter.acquire(f"{tier}:{route}:{key}", rate, burst))
+            if retry_after:
+                REQUESTS_REJECTED.inc(route=route, reason="rate_limited")
+                await self.reject(scope, receive, send, 429, "Too many requests", retry_after)
+                return
+
+        if not expensive:
+            await self.app(scope, receive, send)
+            return
+        try:
+            await asyncio.wait_for(expensive_pool.acquire(), timeout=EXPENSIVE_QUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            REQUESTS_REJECTED.inc(route=route, reason="busy")
+            await self.reject(scope, receive, send, 503, "Server busy with expensive requests, retry later",
+                              EXPENSIVE_QUEUE_TIMEOUT)
+            return
+        EXPENSIVE_IN_FLIGHT.inc()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            EXPENSIVE_IN_FLIGHT.inc(-1)
+            expensive_pool.release()
+
 # Include the router in the main app
 app.include_router(api_router)
 
+app.add_middleware(RequestMetricsMiddleware)
+app.add_middleware(AdmissionControlMiddleware)
+app.add_middleware(CompressionMiddleware, minimum_size=COMPRESSION_MIN_SIZE, maximum_size=COMPRESSION_MAX_SIZE)
+
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
@@ -404,17 +3251,150 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Startup leader lock
+async def acquire_lock(name: str, ttl: float) -> bool:
+    """Take a Mongo-based lock shared by all workers; expired locks can be taken over"""
+    now = datetime.now(timezone.utc)
+    try:
+        await db.locks.find_one_and_update(
+            {"_id": name, "$or": [{"expires_at": {"$lt": now}}, {"owner": WORKER_ID}]},
+            {"$set": {"owner": WORKER_ID, "expires_at": now + timedelta(seconds=ttl)}},
+            upsert=True
+        )
+        return True
+    except DuplicateKeyError:
+        # Another worker holds an unexpired lock
+        return False
+
+async def release_lock(name: str):
+    await db.locks.delete_one({"_id": name, "owner": WORKER_ID})
+
+async def renew_lock(name: str, ttl: float):
+    """Keep extending a held lock until cancelled"""
+    while True:
+        await asyncio.sleep(ttl / 3)
+        try:
+            if not await acquire_lock(name, ttl):
+                logger.warning(f"Worker {WORKER_ID} lost the {name} lock")
+                return
+        except Exception as e:
+            logger.warning(f"Could not renew the {name} lock: {str(e)}")
+
+async def run_startup_tasks():
+    """Idempotent startup tasks: indexes and migrations"""
+    await ensure_indexes()
+    await migrate_string_dates()
+    await backfill_search_fields()
+    if CHAT_STORAGE == "collection":
+        await migrate_messages_to_collection()
+
+async def seed_on_startup():
+    """Development test data; wiping must not be repeated by later workers"""
+    if SEED_ON_STARTUP == "wipe":
+        await generate_test_data()
+    elif SEED_ON_STARTUP == "if-empty" and await db.chats.estimated_document_count() == 0:
+        await generate_test_data(wipe=False)
+
 @app.on_event("startup")
 async def startup_event():
-    """Generate test data on startup"""
+    """Run one-time startup tasks in a single worker"""
+    global http_client
+    http_client = create_http_client()
+
+    if STARTUP_MODE != "production":
+        print("\n📡 Registered routes:")
+        for route in app.routes:
+            if hasattr(route, "methods"):
+                methods = ", ".join(route.methods)
+                print(f"{methods:10} {route.path}")
 
-    print("\n📡 Registered routes:")
-    for route in app.routes:
-        if hasattr(route, "methods"):
-            methods = ", ".join(route.methods)
-            print(f"{methods:10} {route.path}")
-    await generate_test_data()
+    # With several workers only the lock holder runs the tasks; the others start
+    # serving. Seeding is recorded per deploy so later workers do not wipe again.
+    if not await acquire_lock("startup-tasks", STARTUP_LOCK_TTL):
+        logger.info(f"Worker {WORKER_ID} skipped startup tasks: another worker is running them")
+        return
+    renewal = asyncio.ensure_future(renew_lock("startup-tasks", STARTUP_LOCK_TTL))
+    try:
+        await run_startup_tasks()
+        if STARTUP_MODE != "production" and SEED_ON_STARTUP in ("wipe", "if-empty"):
+            deploy_id = startup_deploy_id()
+            if await db.startup_runs.find_one({"_id": deploy_id}):
+                logger.info(f"Worker {WORKER_ID} skipped seeding: already done for deploy {deploy_id}")
+            else:
+                await seed_on_startup()
+                await db.startup_runs.update_one(
+                    {"_id": deploy_id},
+                    {"$setOnInsert": {"worker": WORKER_ID, "completed_at": datetime.now(timezone.utc)}},
+                    upsert=True
+                )
+    finally:
+        renewal.cancel()
+        await release_lock("startup-tasks")
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    change_feed.stop()
     client.close()
+    if http_client is not None:
+        await http_client.aclose()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Жилищный баланс - Админ панель backend")
+    subparsers = parser.add_subparsers(dest="command")
+
+    serve_parser = subparsers.add_parser("serve", help="Run the API server (default)")
+    serve_parser.add_argument("--host", default="0.0.0.0")
+    serve_parser.add_argument("--port", type=int, default=8000)
+    serve_parser.add_argument("--workers", type=int, default=1, help="Number of worker processes")
+
+    subparsers.add_parser("rebuild-daily-stats", help="Backfill/rebuild the daily_stats rollup")
+    subparsers.add_parser("migrate-dates", help="Convert ISO string timestamps to native dates")
+    subparsers.add_parser("migrate-messages", help="Move embedded chat messages to the messages collection")
+
+    generate_parser = subparsers.add_parser("generate", help="Generate synthetic test data")
+    generate_parser.add_argument("--clients", type=int, default=50)
+    generate_parser.add_argument("--min-messages", type=int, default=3)
+    generate_parser.add_argument("--max-messages", type=int, default=15)
+    generate_parser.add_argument("--chunk-size", type=int, default=5000)
+    generate_parser.add_argument("--concurrency", type=int, default=4)
+    generate_parser.add_argument("--seed", type=int, default=None)
+    generate_parser.add_argument("--no-wipe", action="store_true", help="Append instead of replacing data")
+
+    args = parser.parse_args()
+
+    if args.command == "rebuild-daily-stats":
+        asyncio.run(rebuild_daily_stats())
+        print("Daily statistics rebuilt")
+    elif args.command == "migrate-dates":
+        asyncio.run(migrate_string_dates())
+    elif args.command == "migrate-messages":
+        asyncio.run(migrate_messages_to_collection())
+    elif args.command == "generate":
+        try:
+            asyncio.run(generate_test_data(
+                args.clients,
+                args.min_messages,
+                args.max_messages,
+                wipe=not args.no_wipe,
+                chunk_size=args.chunk_size,
+                concurrency=args.concurrency,
+                seed=args.seed
+            ))
+        except ValueError as e:
+            generate_parser.error(str(e))
+    else:
+        import uvicorn
+
+        # Workers inherit it, so startup tasks run once for this launch
+        os.environ.setdefault("STARTUP_DEPLOY_ID", uuid.uuid4().hex)
+        workers = getattr(args, "workers", 1)
+        uvicorn.run(
+            "server:app" if workers > 1 else app,
+            app_dir=str(ROOT_DIR),
+            host=getattr(args, "host", "0.0.0.0"),
+            port=getattr(args, "port", 8000),
+            workers=workers
+        )
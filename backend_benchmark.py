@@ -0,0 +1,338 @@
+"""Latency/throughput benchmark for the backend API.
+
+Starts the FastAPI app from backend/server.py against a local MongoDB (or
+mongomock-motor) and a local stand-in for the n8n statistics webhook, each
+as its own uvicorn process, seeds synthetic data and drives the main
+endpoints at a fixed concurrency from this process. Results (p50/p95/p99 latency and req/s per scenario, and which
+statistics source answered) are written to a JSON file so runs can be
+compared across commits. Statistics are measured both with the default
+source order and with STATISTICS_SOURCE=webhook, the only scenarios the
+stub's --webhook-delay and --webhook-failure-rate apply to (unless the
+local source fails, as under --mongomock, which lacks $unionWith).
+
+    python backend_benchmark.py --clients 5000 --concurrency 20 --output bench.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import httpx
+import uvicorn
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse
+
+ROOT_DIR = Path(__file__).parent
+
+
+def create_n8n_stub(delay: float, failure_rate: float) -> FastAPI:
+    """Local stand-in for the n8n statistics webhook"""
+    stub = FastAPI()
+
+    @stub.post("/webhook/gb/statistics/getstatistics")
+    async def getstatistics(payload: dict):
+        await asyncio.sleep(delay)
+        if random.random() < failure_rate:
+            return JSONResponse({"message": "Simulated workflow failure"}, status_code=500)
+        return {
+            "totalDeals": 40,
+            "consultationScheduled": 15,
+            "individualConsultationScheduled": 12,
+            "noResponse": 13,
+            "averageInteractionsPerClient": 9.0,
+            "averageDialogCost": 15.0,
+            "averageConversionCost": 22.2,
+            "totalTokensUsed": 50000,
+            "totalPeriodCost": 600.0,
+            "periodStart": payload.get("start_date"),
+            "periodEnd": payload.get("end_date")
+        }
+
+    return stub
+
+
+def percentile(sorted_values, pct: float) -> float:
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, int(round(pct / 100.0 * len(sorted_values))))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+class BackendBenchmark:
+    def __init__(self, base_url: str, concurrency: int, requests_per_scenario: int):
+        self.base_url = base_url
+        self.api_url = f"{base_url}/api"
+        self.concurrency = concurrency
+        self.requests_per_scenario = requests_per_scenario
+        self.results = {}
+
+    async def run_scenario(self, name: str, make_request):
+        """Run ``make_request(http, i)`` N times at the configured concurrency"""
+        latencies = []
+        errors = 0
+        sources = {}
+        counter = iter(range(self.requests_per_scenario))
+
+        async def worker(http: httpx.AsyncClient):
+            nonlocal errors
+            for i in counter:
+                started = time.perf_counter()
+                try:
+                    response = await make_request(http, i)
+                    if response.status_code >= 400:
+                        errors += 1
+                    source = response.headers.get("x-statistics-source")
+                    if source:
+                        sources[source] = sources.get(source, 0) + 1
+                except httpx.HTTPError:
+                    errors += 1
+                latencies.append((time.perf_counter() - started) * 1000.0)
+
+        limits = httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency)
+        async with httpx.AsyncClient(base_url=self.api_url, timeout=60.0, limits=limits) as http:
+            started = time.perf_counter()
+            await asyncio.gather(*(worker(http) for _ in range(self.concurrency)))
+            elapsed = time.perf_counter() - started
+
+        latencies.sort()
+        self.results[name] = {
+            "requests": len(latencies),
+            "errors": errors,
+            "concurrency": self.concurrency,
+            "duration_s": round(elapsed, 3),
+            "req_per_s": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+            "mean_ms": round(sum(latencies) / len(latencies), 3) if latencies else 0.0,
+            "p50_ms": round(percentile(latencies, 50), 3),
+            "p95_ms": round(percentile(latencies, 95), 3),
+            "p99_ms": round(percentile(latencies, 99), 3),
+            "max_ms": round(latencies[-1], 3) if latencies else 0.0
+        }
+        if sources:
+            # Which statistics source answered, e.g. {"mongo": 480, "static": 20}
+            self.results[name]["statistics_sources"] = sources
+        result = self.results[name]
+        print(f"📈 {name:28} p50={result['p50_ms']:8.2f}ms p95={result['p95_ms']:8.2f}ms "
+              f"p99={result['p99_ms']:8.2f}ms {result['req_per_s']:8.1f} req/s errors={errors}"
+              + (f" sources={sources}" if sources else ""))
+
+    async def run_statistics(self, prefix: str):
+        end_date = datetime.now(timezone.utc)
+        start_date = end_date - timedelta(days=30)
+
+        await self.run_scenario(
+            f"{prefix}_default",
+            lambda http, i: http.get("/statistics")
+        )
+        await self.run_scenario(
+            f"{prefix}_range",
+            lambda http, i: http.get("/statistics", params={
+                "start_date": (start_date + timedelta(days=i % 7)).date().isoformat(),
+                "end_date": end_date.date().isoformat()
+            })
+        )
+
+    async def run_all(self, client_ids, total_chats: int):
+        deep_offset = max(0, total_chats - 20)
+
+        await self.run_statistics("statistics")
+        await self.run_scenario(
+            "chats_first_page",
+            lambda http, i: http.get("/chats", params={"limit": 20})
+        )
+        await self.run_scenario(
+            "chats_search",
+            lambda http, i: http.get("/chats", params={"limit": 20, "search": f"Клиент {i % 100 + 1}"})
+        )
+        await self.run_scenario(
+            "chats_deep_offset",
+            lambda http, i: http.get("/chats", params={"limit": 20, "offset": deep_offset})
+        )
+        await self.run_scenario(
+            "chat_details",
+            lambda http, i: http.get(f"/chats/{client_ids[i % len(client_ids)]}")
+        )
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=ROOT_DIR, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def serve_api(args):
+    """--role api: the app under uvicorn, seeded on startup when --clients > 0"""
+    sys.path.insert(0, str(ROOT_DIR / "backend"))
+    import server
+
+    # server.py logs at INFO; per-request lines would be written inside the measured loop
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    if args.mongomock:
+        from mongomock_motor import AsyncMongoMockClient
+
+        server.client = AsyncMongoMockClient(tz_aware=True)
+        server.db = server.client[args.db_name]
+        server.analytics_db = server.list_db = server.db
+
+    if args.clients:
+        async def seed():
+            print(f"🌱 Seeding {args.clients} clients...")
+            await server.generate_test_data(args.clients, seed=args.seed)
+        server.app.router.on_startup.append(seed)
+
+    uvicorn.run(server.app, host="127.0.0.1", port=args.port, log_level="warning", access_log=False)
+
+
+def serve_stub(args):
+    """--role stub: the n8n webhook stand-in under uvicorn"""
+    random.seed(args.seed)
+    uvicorn.run(
+        create_n8n_stub(args.webhook_delay, args.webhook_failure_rate),
+        host="127.0.0.1", port=args.stub_port, log_level="warning", access_log=False
+    )
+
+
+def spawn(role: str, args, env: dict, clients: int = 0) -> subprocess.Popen:
+    command = [
+        sys.executable, str(Path(__file__).resolve()), "--role", role,
+        "--db-name", args.db_name, "--clients", str(clients), "--seed", str(args.seed),
+        "--port", str(args.port), "--stub-port", str(args.stub_port),
+        "--webhook-delay", str(args.webhook_delay), "--webhook-failure-rate", str(args.webhook_failure_rate)
+    ]
+    if args.mongomock:
+        command.append("--mongomock")
+    return subprocess.Popen(command, env=env)
+
+
+async def wait_until_ready(url: str, process: subprocess.Popen, timeout: float = 600.0):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(timeout=5.0) as http:
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError(f"{url} exited with code {process.returncode} before becoming ready")
+            try:
+                await http.get(url)
+                return
+            except httpx.HTTPError:
+                await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} did not become ready within {timeout:.0f}s")
+
+
+def stop(process: subprocess.Popen):
+    process.terminate()
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+async def run(args):
+    # The API and the stub run in their own processes so only the client
+    # shares this event loop with the measurements
+    env = {
+        **os.environ,
+        "MONGO_URL": args.mongo_url,
+        "DB_NAME": args.db_name,
+        "N8N_BASE_URL": f"http://127.0.0.1:{args.stub_port}",
+        "SEED_ON_STARTUP": "off",
+        "PYTHONUNBUFFERED": "1"
+    }
+    env.setdefault("STATISTICS_WEBHOOK_FALLBACK", "true")
+    # No route listing; seeding is done by the --role api startup hook
+    env.setdefault("STARTUP_MODE", "production")
+    # Every benchmark request comes from one address
+    env.setdefault("RATE_LIMIT_ENABLED", "off")
+    if args.no_cache:
+        env["STATISTICS_CACHE_TTL"] = "0"
+        env["STATISTICS_CACHE_STALE_TTL"] = "0"
+
+    base_url = f"http://127.0.0.1:{args.port}"
+    benchmark = BackendBenchmark(base_url, args.concurrency, args.requests)
+    stub = spawn("stub", args, env)
+    try:
+        await wait_until_ready(f"http://127.0.0.1:{args.stub_port}/openapi.json", stub)
+
+        api = spawn("api", args, env, clients=args.clients)
+        try:
+            await wait_until_ready(f"{base_url}/api/", api)
+            async with httpx.AsyncClient(base_url=benchmark.api_url, timeout=60.0) as http:
+                page = (await http.get("/chats", params={"limit": 500})).json()
+            client_ids = [chat["client_id"] for chat in page["chats"]]
+            await benchmark.run_all(client_ids, page["total"])
+        finally:
+            stop(api)
+
+        # Same statistics load with the n8n webhook (the stub) asked first. An
+        # in-memory mongomock database is per process, so it is seeded again.
+        api = spawn("api", args, {**env, "STATISTICS_SOURCE": "webhook"},
+                    clients=args.clients if args.mongomock else 0)
+        try:
+            await wait_until_ready(f"{base_url}/api/", api)
+            await benchmark.run_statistics("statistics_webhook")
+        finally:
+            stop(api)
+    finally:
+        stop(stub)
+
+    report = {
+        "revision": git_revision(),
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "parameters": {
+            "clients": args.clients,
+            "concurrency": args.concurrency,
+            "requests_per_scenario": args.requests,
+            "webhook_delay_s": args.webhook_delay,
+            "webhook_failure_rate": args.webhook_failure_rate,
+            "statistics_cache": not args.no_cache,
+            "statistics_source": env.get("STATISTICS_SOURCE", "mongo"),
+            "storage": "mongomock" if args.mongomock else "mongodb"
+        },
+        "scenarios": benchmark.results
+    }
+    Path(args.output).write_text(json.dumps(report, indent=2, ensure_ascii=False))
+    print(f"💾 Results written to {args.output}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Backend API benchmark")
+    parser.add_argument("--mongo-url", default=os.environ.get("MONGO_URL", "mongodb://localhost:27017"))
+    parser.add_argument("--db-name", default="gb_benchmark")
+    parser.add_argument("--mongomock", action="store_true", help="Use mongomock-motor instead of MongoDB")
+    parser.add_argument("--clients", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--requests", type=int, default=500, help="Requests per scenario")
+    parser.add_argument("--webhook-delay", type=float, default=0.2, help="Stub webhook delay in seconds")
+    parser.add_argument("--webhook-failure-rate", type=float, default=0.1)
+    parser.add_argument("--no-cache", action="store_true", help="Disable the statistics cache")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--stub-port", type=int, default=8766)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", default="benchmark_results.json")
+    # Internal: the benchmark starts itself again as the API and the stub
+    parser.add_argument("--role", choices=["client", "api", "stub"], default="client", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.role == "api":
+        serve_api(args)
+        return 0
+    if args.role == "stub":
+        serve_stub(args)
+        return 0
+
+    print("🏠 Жилищный баланс - Backend API Benchmark")
+    print("=" * 50)
+    asyncio.run(run(args))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,78 @@
+import os
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import pytest
+
+# server.py reads its configuration at import time
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "test_database")
+os.environ.setdefault("SEED_ON_STARTUP", "off")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import server  # noqa: E402
+
+
+@pytest.fixture
+def mongo(monkeypatch):
+    """Point every database handle of the app at a fresh mongomock database"""
+    from mongomock_motor import AsyncMongoMockClient
+
+    database = AsyncMongoMockClient(tz_aware=True)["test_database"]
+    for name in ("db", "analytics_db", "list_db"):
+        monkeypatch.setattr(server, name, database)
+    # Rate-limit buckets must not carry over between tests
+    monkeypatch.setattr(server, "rate_limiter", server.TokenBucketLimiter())
+    return database
+
+
+class FakeClock:
+    """Stands in for the ``time`` module inside server.py; the event loop keeps the real one"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(server, "time", clock)
+    return clock
+
+
+def make_chat(index: int, messages: int = 0, **fields) -> dict:
+    """Chat document as stored with embedded messages"""
+    started_at = datetime(2024, 1, 1, tzinfo=timezone.utc) + timedelta(hours=index)
+    chat = {
+        "id": str(uuid.uuid4()),
+        "client_id": f"client_{index}",
+        "client_name": f"Клиент {index}",
+        "client_phone": f"+7900{index:07d}",
+        "status": "active",
+        "started_at": started_at,
+        "last_message_at": started_at + timedelta(minutes=messages),
+        "total_interactions": messages,
+        "dialog_cost": 0.0,
+        "total_tokens_used": 10 * messages,
+        "messages": [
+            {
+                "id": f"{index}-{position}",
+                "timestamp": started_at + timedelta(minutes=position),
+                "sender": "bot" if position % 2 else "client",
+                "message": f"Сообщение {position}",
+                "tokens_used": 10
+            }
+            for position in range(messages)
+        ]
+    }
+    chat.update(fields)
+    return chat
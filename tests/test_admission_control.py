@@ -0,0 +1,43 @@
+import uuid
+
+from fastapi.testclient import TestClient
+
+import server
+
+
+def limit_to(monkeypatch, burst: int):
+    monkeypatch.setattr(server, "RATE_LIMIT_ENABLED", True)
+    monkeypatch.setattr(server, "RATE_LIMIT_RATE", 0.001)
+    monkeypatch.setattr(server, "RATE_LIMIT_BURST", burst)
+
+
+def test_requests_over_the_burst_get_429(mongo, monkeypatch):
+    limit_to(monkeypatch, 3)
+    client = TestClient(server.app)
+
+    statuses = [client.get("/api/").status_code for _ in range(4)]
+
+    assert statuses == [200, 200, 200, 429]
+    assert int(client.get("/api/").headers["retry-after"]) >= 1
+
+
+def test_client_id_header_does_not_escape_the_ip_bucket(mongo, monkeypatch):
+    limit_to(monkeypatch, 3)
+    client = TestClient(server.app)
+
+    statuses = [
+        client.get("/api/", headers={"X-Client-Id": str(uuid.uuid4())}).status_code
+        for _ in range(4)
+    ]
+
+    assert statuses[-1] == 429
+
+
+def test_client_id_gets_its_own_bucket_too(mongo, monkeypatch):
+    limit_to(monkeypatch, 2)
+    monkeypatch.setattr(server.AdmissionControlMiddleware, "client_keys",
+                        staticmethod(lambda scope: ["ip:shared", "id:same"]))
+    client = TestClient(server.app)
+
+    assert [client.get("/api/").status_code for _ in range(3)] == [200, 200, 429]
+
@@ -0,0 +1,76 @@
+import asyncio
+
+from pymongo.errors import OperationFailure
+
+import server
+
+
+class FakeStream:
+    resume_token = {"_data": "next"}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        await asyncio.Event().wait()
+
+
+class FakeDatabase:
+    def __init__(self):
+        self.resumed_from = []
+        self.pipelines = []
+
+    def watch(self, pipeline, full_document=None, resume_after=None):
+        self.resumed_from.append(resume_after)
+        self.pipelines.append(pipeline)
+        if resume_after is not None:
+            raise OperationFailure("Resume point no longer in the oplog", code=286)
+        return FakeStream()
+
+
+def test_lost_resume_token_starts_a_fresh_stream(monkeypatch):
+    database = FakeDatabase()
+    monkeypatch.setattr(server, "db", database)
+
+    async def scenario():
+        hub = server.ChangeFeedHub(queue_size=10)
+        hub._resume_token = {"_data": "expired"}
+        queue = hub.subscribe()
+        await asyncio.sleep(0.01)
+        hub.unsubscribe(queue)
+        return hub, queue.get_nowait()
+
+    hub, event = asyncio.run(scenario())
+
+    assert event == {"type": "resync"}
+    assert database.resumed_from == [{"_data": "expired"}, None]
+    assert hub._resume_token is None
+
+
+def test_stop_forgets_resume_token():
+    hub = server.ChangeFeedHub(queue_size=10)
+    hub._resume_token = {"_data": "old"}
+    hub.stop()
+    assert hub._resume_token is None
+
+
+def test_deletes_are_not_streamed(monkeypatch):
+    database = FakeDatabase()
+    monkeypatch.setattr(server, "db", database)
+
+    async def scenario():
+        hub = server.ChangeFeedHub(queue_size=10)
+        queue = hub.subscribe()
+        await asyncio.sleep(0.01)
+        hub.unsubscribe(queue)
+
+    asyncio.run(scenario())
+
+    operations = database.pipelines[0][0]["$match"]["operationType"]["$in"]
+    assert "delete" not in operations
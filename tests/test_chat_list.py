@@ -0,0 +1,54 @@
+import asyncio
+
+import pytest
+from fastapi.testclient import TestClient
+
+import server
+from .conftest import make_chat
+
+
+@pytest.mark.parametrize("params", [{"limit": 0}, {"limit": -1}, {"limit": 501}, {"offset": -1}])
+def test_out_of_range_paging_is_rejected(mongo, params):
+    client = TestClient(server.app)
+    assert client.get("/api/chats", params=params).status_code == 422
+
+
+def test_pages_follow_the_cursor(mongo):
+    asyncio.run(mongo.chats.insert_many([make_chat(index) for index in range(5)]))
+    client = TestClient(server.app)
+
+    first = client.get("/api/chats", params={"limit": 3}).json()
+    second = client.get("/api/chats", params={"limit": 3, "after": first["next_cursor"]}).json()
+
+    assert first["total"] == 5
+    assert [chat["client_id"] for chat in first["chats"] + second["chats"]] == [
+        f"client_{index}" for index in range(4, -1, -1)
+    ]
+    assert second["next_cursor"] is None
+
+
+@pytest.mark.parametrize("path, params", [
+    ("/api/chats/client_1", {"messages_limit": 0}),
+    ("/api/chats/client_1", {"messages_limit": -2}),
+    ("/api/chats/client_1/messages", {"limit": -2}),
+])
+def test_non_positive_message_limits_are_rejected(mongo, path, params):
+    asyncio.run(mongo.chats.insert_one(make_chat(1, messages=3)))
+    client = TestClient(server.app)
+    assert client.get(path, params=params).status_code == 422
+
+
+def test_page_etag_follows_new_messages(mongo):
+    asyncio.run(mongo.chats.insert_many([make_chat(index) for index in range(3)]))
+    client = TestClient(server.app)
+
+    etag = client.get("/api/chats").headers["etag"]
+    assert client.get("/api/chats", headers={"If-None-Match": etag}).status_code == 304
+
+    asyncio.run(mongo.chats.update_one(
+        {"client_id": "client_0"},
+        {"$set": {"last_message_at": server.datetime.now(server.timezone.utc)}}
+    ))
+    refreshed = client.get("/api/chats", headers={"If-None-Match": etag})
+    assert refreshed.status_code == 200
+    assert refreshed.json()["chats"][0]["client_id"] == "client_0"
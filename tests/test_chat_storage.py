@@ -0,0 +1,83 @@
+import asyncio
+import json
+from datetime import timedelta
+
+from fastapi.testclient import TestClient
+
+import server
+from .conftest import make_chat
+
+
+def seed_partly_migrated_chat(mongo):
+    """Chat still embedding three messages, plus two ingested into the collection since"""
+    chat = make_chat(1, messages=3)
+    later = chat["last_message_at"] + timedelta(minutes=5)
+    stored = [
+        # Copy left by an interrupted migration
+        server.message_document(chat, chat["messages"][2]),
+        *(server.message_document(chat, {
+            "id": f"new-{position}",
+            "timestamp": later + timedelta(minutes=position),
+            "sender": "client",
+            "message": "Новое сообщение",
+            "tokens_used": 5
+        }) for position in range(2))
+    ]
+
+    async def seed():
+        await mongo.chats.insert_one(chat)
+        await mongo.messages.insert_many(stored)
+
+    asyncio.run(seed())
+    return chat
+
+
+def test_chat_details_merge_embedded_and_collection_messages(mongo, monkeypatch):
+    monkeypatch.setattr(server, "CHAT_STORAGE", "collection")
+    seed_partly_migrated_chat(mongo)
+    client = TestClient(server.app)
+
+    messages = client.get("/api/chats/client_1").json()["messages"]
+    assert [message["id"] for message in messages] == ["1-0", "1-1", "1-2", "new-0", "new-1"]
+
+
+def test_message_stream_merges_embedded_and_collection_messages(mongo, monkeypatch):
+    monkeypatch.setattr(server, "CHAT_STORAGE", "collection")
+    chat = seed_partly_migrated_chat(mongo)
+
+    async def collect():
+        lines = [line async for line in server.stream_chat_messages(
+            "client_1", {"id": chat["id"], "embedded": True}, None, None
+        )]
+        return [json.loads(line)["id"] for line in lines]
+
+    assert asyncio.run(collect()) == ["1-0", "1-1", "1-2", "new-0", "new-1"]
+
+
+def test_merge_messages_prefers_one_copy_per_id():
+    chat = make_chat(2, messages=2)
+    merged = server.merge_messages(chat["messages"], [dict(chat["messages"][1])])
+    assert [message["id"] for message in merged] == ["2-0", "2-1"]
+
+
+def test_flattened_export_streams_both_message_sources(mongo, monkeypatch):
+    monkeypatch.setattr(server, "CHAT_STORAGE", "collection")
+    monkeypatch.setattr(server, "EXPORT_BATCH_SIZE", 1)
+    seed_partly_migrated_chat(mongo)
+    migrated = make_chat(2, messages=2)
+    stored = [server.message_document(migrated, message) for message in migrated.pop("messages")]
+
+    async def seed():
+        await mongo.chats.insert_one(migrated)
+        await mongo.messages.insert_many(stored)
+
+    asyncio.run(seed())
+    client = TestClient(server.app)
+
+    response = client.get("/api/export/chats", params={"flatten_messages": "true"})
+
+    rows = response.content.decode("utf-8-sig").splitlines()
+    header = rows[0].split(",")
+    message_ids = [row.split(",")[header.index("message_id")] for row in rows[1:]]
+    assert message_ids[:3] == ["1-0", "1-1", "1-2"]
+    assert sorted(message_ids[3:]) == ["2-0", "2-1", "new-0", "new-1"]
@@ -0,0 +1,148 @@
+import asyncio
+
+import pytest
+
+import server
+
+
+def make_breaker(**overrides):
+    options = dict(window=4, min_calls=4, failure_rate=0.5, slow_call_rate=0.5,
+                   slow_call_seconds=1.0, cooldown=30.0, min_timeout=0.5, max_timeout=10.0)
+    options.update(overrides)
+    return server.CircuitBreaker("test", **options)
+
+
+def call(breaker, clock, duration=0.0, fail=False):
+    """Run one call through the breaker that takes ``duration`` seconds of fake time"""
+    async def upstream(timeout):
+        clock.now += duration
+        if fail:
+            raise RuntimeError("upstream failed")
+        return timeout
+
+    async def run():
+        try:
+            return await breaker.call(upstream)
+        except RuntimeError:
+            return None
+    return asyncio.run(run())
+
+
+def test_opens_on_failure_rate(clock):
+    breaker = make_breaker()
+    for fail in (False, True, False):
+        call(breaker, clock, fail=fail)
+    assert breaker.state == breaker.CLOSED
+
+    call(breaker, clock, fail=True)
+
+    assert breaker.state == breaker.OPEN
+    with pytest.raises(server.CircuitOpenError):
+        asyncio.run(breaker.call(pytest.fail))
+    assert breaker.short_circuited == 1
+
+
+def test_opens_on_slow_call_rate(clock):
+    breaker = make_breaker()
+    for duration in (0.1, 2.0, 0.1):
+        call(breaker, clock, duration=duration)
+    assert breaker.state == breaker.CLOSED
+
+    call(breaker, clock, duration=2.0)
+
+    assert breaker.state == breaker.OPEN
+
+
+def test_half_open_lets_a_single_probe_through(clock):
+    breaker = make_breaker()
+    for _ in range(4):
+        call(breaker, clock, fail=True)
+    clock.now += 30.0
+
+    async def scenario():
+        release = asyncio.Event()
+
+        async def probe(timeout):
+            await release.wait()
+            return "ok"
+
+        first = asyncio.ensure_future(breaker.call(probe))
+        await asyncio.sleep(0)
+        assert breaker.state == breaker.HALF_OPEN
+        with pytest.raises(server.CircuitOpenError):
+            await breaker.call(pytest.fail)
+        release.set()
+        return await first
+
+    assert asyncio.run(scenario()) == "ok"
+    assert breaker.state == breaker.CLOSED
+
+
+def test_failed_probe_opens_again(clock):
+    breaker = make_breaker()
+    for _ in range(4):
+        call(breaker, clock, fail=True)
+    clock.now += 30.0
+
+    call(breaker, clock, fail=True)
+
+    assert breaker.state == breaker.OPEN
+    clock.now += 29.0
+    with pytest.raises(server.CircuitOpenError):
+        asyncio.run(breaker.call(pytest.fail))
+
+
+def test_cancelled_probe_frees_the_probe_slot(clock):
+    breaker = make_breaker()
+    for _ in range(4):
+        call(breaker, clock, fail=True)
+    clock.now += 30.0
+
+    async def scenario():
+        probe = asyncio.ensure_future(breaker.call(lambda timeout: asyncio.sleep(60)))
+        await asyncio.sleep(0)
+        probe.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await probe
+
+    asyncio.run(scenario())
+
+    # Cancellation is not a failure: still half-open, and the next probe may run
+    assert breaker.state == breaker.HALF_OPEN
+    assert call(breaker, clock) is not None
+    assert breaker.state == breaker.CLOSED
+
+
+def test_cancelled_calls_are_not_counted_as_failures(clock):
+    breaker = make_breaker(min_calls=1, window=1)
+
+    async def scenario():
+        task = asyncio.ensure_future(breaker.call(lambda timeout: asyncio.sleep(60)))
+        await asyncio.sleep(0)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(scenario())
+
+    assert breaker.state == breaker.CLOSED
+
+
+def test_adaptive_timeout_is_clamped(clock):
+    breaker = make_breaker(slow_call_seconds=100.0)
+    # Not enough samples yet: allow the maximum
+    assert breaker.timeout() == 10.0
+
+    for _ in range(4):
+        call(breaker, clock, duration=0.01)
+    assert breaker.timeout() == 0.5
+
+    for _ in range(20):
+        call(breaker, clock, duration=2.0)
+    assert breaker.timeout() == pytest.approx(6.0)
+
+    for _ in range(100):
+        call(breaker, clock, duration=50.0)
+    assert breaker.timeout() == 10.0
+    # Each call receives the timeout computed before it ran
+    assert call(breaker, clock) == 10.0
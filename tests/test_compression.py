@@ -0,0 +1,58 @@
+import asyncio
+import gzip
+
+from fastapi.testclient import TestClient
+
+import server
+from .conftest import make_chat
+
+
+def test_api_json_is_gzipped(mongo):
+    asyncio.run(mongo.chats.insert_many([make_chat(index) for index in range(30)]))
+    client = TestClient(server.app)
+
+    response = client.get("/api/chats", params={"limit": 20}, headers={"Accept-Encoding": "gzip"})
+
+    assert response.status_code == 200
+    assert response.headers["content-encoding"] == "gzip"
+    assert "Accept-Encoding" in response.headers["vary"]
+    assert len(response.json()["chats"]) == 20
+
+
+def test_metrics_is_gzipped(mongo):
+    client = TestClient(server.app)
+    client.get("/api/")
+
+    response = client.get("/metrics", headers={"Accept-Encoding": "gzip"})
+
+    assert response.headers["content-encoding"] == "gzip"
+    assert "http_request_duration_seconds" in response.text
+
+
+def test_small_and_unaccepted_responses_are_not_compressed(mongo):
+    client = TestClient(server.app)
+
+    assert "content-encoding" not in client.get("/api/", headers={"Accept-Encoding": "gzip"}).headers
+    response = client.get("/metrics", headers={"Accept-Encoding": "identity"})
+    assert "content-encoding" not in response.headers
+
+
+def test_chunked_body_is_buffered_before_compressing():
+    body = b"x" * 4096
+
+    async def chunked_app(scope, receive, send):
+        await send({"type": "http.response.start", "status": 200,
+                    "headers": [(b"content-length", str(len(body)).encode())]})
+        await send({"type": "http.response.body", "body": body[:1000], "more_body": True})
+        await send({"type": "http.response.body", "body": body[1000:], "more_body": False})
+
+    sent = []
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "method": "GET", "path": "/", "headers": [(b"accept-encoding", b"gzip")]}
+    asyncio.run(server.CompressionMiddleware(chunked_app, minimum_size=1024)(scope, None, send))
+
+    assert dict(sent[0]["headers"])[b"content-encoding"] == b"gzip"
+    assert gzip.decompress(sent[1]["body"]) == body
@@ -0,0 +1,21 @@
+import asyncio
+
+import pytest
+from fastapi.testclient import TestClient
+
+import server
+from .conftest import make_chat
+
+
+@pytest.mark.parametrize("path", ["/api/chats", "/api/chats/client_1"])
+def test_fast_path_matches_the_pydantic_body(mongo, monkeypatch, path):
+    asyncio.run(mongo.chats.insert_many([make_chat(index, messages=2) for index in range(3)]))
+    client = TestClient(server.app)
+
+    monkeypatch.setattr(server, "FAST_JSON_RESPONSES", False)
+    default = client.get(path)
+    monkeypatch.setattr(server, "FAST_JSON_RESPONSES", True)
+    fast = client.get(path)
+
+    assert default.status_code == fast.status_code == 200
+    assert fast.json() == default.json()
@@ -0,0 +1,34 @@
+import asyncio
+
+import numpy as np
+import pytest
+from fastapi.testclient import TestClient
+
+import server
+
+
+@pytest.mark.parametrize("sizes", [
+    {"num_clients": 0},
+    {"min_messages": 0},
+    {"min_messages": 5, "max_messages": 4},
+    {"chunk_size": 0},
+    {"concurrency": 0},
+])
+def test_invalid_sizes_are_rejected(mongo, sizes):
+    with pytest.raises(ValueError):
+        asyncio.run(server.generate_test_data(**sizes))
+    assert asyncio.run(mongo.chats.count_documents({})) == 0
+
+
+def test_endpoint_rejects_chats_without_messages(mongo):
+    client = TestClient(server.app)
+    response = client.post("/api/generate-test-data", params={"min_messages": 0})
+    assert response.status_code == 400
+
+
+def test_chat_totals_match_their_messages():
+    chats, _ = server.build_test_chunk(np.random.default_rng(7), 0, 50, 1, 4)
+
+    for chat in chats:
+        assert chat["total_interactions"] == len(chat["messages"]) >= 1
+        assert chat["total_tokens_used"] == sum(m["tokens_used"] for m in chat["messages"])
@@ -0,0 +1,84 @@
+import asyncio
+
+import pytest
+from fastapi.testclient import TestClient
+
+import server
+
+EVENTS = [
+    {
+        "type": "message",
+        "client_id": "client_1",
+        "client_name": "Клиент 1",
+        "client_phone": "+79001234567",
+        "dialog_cost": 0.5,
+        "message": {
+            "id": "message-1",
+            "timestamp": "2024-03-01T10:00:00+00:00",
+            "sender": "client",
+            "message": "Здравствуйте",
+            "tokens_used": 12
+        }
+    },
+    {
+        "type": "deal",
+        "id": "deal-1",
+        "client_id": "client_1",
+        "client_name": "Клиент 1",
+        "status": "consultation_scheduled"
+    }
+]
+
+
+@pytest.fixture(params=["embedded", "collection"])
+def storage(request, mongo, monkeypatch):
+    monkeypatch.setattr(server, "CHAT_STORAGE", request.param)
+    asyncio.run(server.ensure_indexes())
+    return request.param
+
+
+async def stored_messages(mongo, storage):
+    if storage == "collection":
+        return await mongo.messages.find({}).to_list(length=None)
+    chat = await mongo.chats.find_one({"client_id": "client_1"})
+    return chat["messages"]
+
+
+def test_retried_batch_is_applied_once(mongo, storage):
+    client = TestClient(server.app)
+
+    first = client.post("/api/ingest", json=EVENTS).json()
+    retry = client.post("/api/ingest", json=EVENTS).json()
+
+    assert first["accepted_messages"] == 1 and first["duplicate_messages"] == 0
+    assert retry["accepted_messages"] == 0 and retry["duplicate_messages"] == 1
+    chat = asyncio.run(mongo.chats.find_one({"client_id": "client_1"}))
+    assert chat["total_interactions"] == 1
+    assert chat["total_tokens_used"] == 12
+    assert chat["dialog_cost"] == 0.5
+    assert len(asyncio.run(stored_messages(mongo, storage))) == 1
+    assert asyncio.run(mongo.deals.count_documents({})) == 1
+
+
+def test_message_without_id_is_rejected(mongo, storage):
+    event = {**EVENTS[0], "message": {key: value for key, value in EVENTS[0]["message"].items() if key != "id"}}
+    client = TestClient(server.app)
+
+    response = client.post("/api/ingest", json=[event]).json()
+
+    assert response["accepted_messages"] == 0
+    assert [rejected["index"] for rejected in response["rejected"]] == [0]
+    assert asyncio.run(mongo.chats.count_documents({})) == 0
+
+
+def test_naive_timestamps_are_utc(mongo, storage):
+    naive = {**EVENTS[0], "message": {**EVENTS[0]["message"], "id": "message-2", "timestamp": "2024-03-01T09:00:00"}}
+    client = TestClient(server.app)
+
+    response = client.post("/api/ingest", json=[EVENTS[0], naive])
+
+    assert response.status_code == 200
+    assert response.json()["accepted_messages"] == 2
+    chat = asyncio.run(mongo.chats.find_one({"client_id": "client_1"}))
+    assert chat["started_at"].isoformat() == "2024-03-01T09:00:00+00:00"
+    assert chat["last_message_at"].isoformat() == "2024-03-01T10:00:00+00:00"
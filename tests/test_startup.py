@@ -0,0 +1,55 @@
+import asyncio
+
+import server
+
+
+def test_migrations_run_every_launch_and_seeding_once_per_deploy(mongo, monkeypatch):
+    migrations = []
+    seeds = []
+
+    async def fake_startup_tasks():
+        migrations.append(server.WORKER_ID)
+
+    async def fake_seed():
+        seeds.append(server.WORKER_ID)
+
+    monkeypatch.setenv("STARTUP_DEPLOY_ID", "release-1")
+    monkeypatch.setattr(server, "SEED_ON_STARTUP", "wipe")
+    monkeypatch.setattr(server, "STARTUP_MODE", "development")
+    monkeypatch.setattr(server, "run_startup_tasks", fake_startup_tasks)
+    monkeypatch.setattr(server, "seed_on_startup", fake_seed)
+
+    async def boot_workers(count: int):
+        for _ in range(count):
+            await server.startup_event()
+            await server.http_client.aclose()
+
+    asyncio.run(boot_workers(2))
+    assert len(migrations) == 2
+    assert len(seeds) == 1
+    assert asyncio.run(mongo.locks.count_documents({})) == 0
+
+    monkeypatch.setenv("STARTUP_DEPLOY_ID", "release-2")
+    asyncio.run(boot_workers(1))
+    assert len(migrations) == 3
+    assert len(seeds) == 2
+
+
+def test_unrelated_parent_is_not_a_shared_launch(monkeypatch):
+    monkeypatch.delenv("STARTUP_DEPLOY_ID", raising=False)
+    # Pretend to be forked by the test runner, which is not a uvicorn/gunicorn master
+    monkeypatch.setattr(server.os, "getppid", server.os.getpid)
+    assert server.startup_deploy_id() == server.WORKER_ID
+
+
+def test_lock_is_renewed_while_tasks_run(mongo, monkeypatch):
+    async def scenario():
+        assert await server.acquire_lock("startup-tasks", 0.3)
+        first = (await mongo.locks.find_one({"_id": "startup-tasks"}))["expires_at"]
+        renewal = asyncio.ensure_future(server.renew_lock("startup-tasks", 0.3))
+        await asyncio.sleep(0.25)
+        renewal.cancel()
+        return first, (await mongo.locks.find_one({"_id": "startup-tasks"}))["expires_at"]
+
+    first, renewed = asyncio.run(scenario())
+    assert renewed > first
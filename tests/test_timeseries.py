@@ -0,0 +1,24 @@
+from fastapi.testclient import TestClient
+
+import server
+
+
+def test_closed_buckets_expire(mongo, clock, monkeypatch):
+    calls = []
+
+    async def fake_buckets(start_dt, end_dt, unit):
+        calls.append((start_dt, end_dt))
+        return {}
+
+    monkeypatch.setattr(server, "compute_timeseries_buckets", fake_buckets)
+    monkeypatch.setattr(server, "timeseries_cache", server.OrderedDict())
+    client = TestClient(server.app)
+    params = {"start_date": "2024-01-01T00:00:00", "end_date": "2024-01-03T23:59:59.999999"}
+
+    assert len(client.get("/api/statistics/timeseries", params=params).json()["buckets"]) == 3
+    client.get("/api/statistics/timeseries", params=params)
+    assert len(calls) == 1
+
+    clock.now += server.TIMESERIES_CACHE_TTL
+    client.get("/api/statistics/timeseries", params=params)
+    assert len(calls) == 2
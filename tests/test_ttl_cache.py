@@ -0,0 +1,134 @@
+import asyncio
+
+import pytest
+
+import server
+
+
+class Loader:
+    """Counts upstream calls; each call returns the next number after a pause"""
+
+    def __init__(self, fail=False):
+        self.calls = 0
+        self.fail = fail
+
+    async def __call__(self):
+        self.calls += 1
+        call = self.calls
+        await asyncio.sleep(0.01)
+        if self.fail:
+            raise RuntimeError("upstream failed")
+        return call
+
+
+def test_concurrent_loads_share_one_call(clock):
+    cache = server.AsyncTTLCache("test", maxsize=8, ttl=60)
+    loader = Loader()
+
+    async def scenario():
+        return await asyncio.gather(*(cache.get_or_load("key", loader) for _ in range(3)))
+
+    assert asyncio.run(scenario()) == [1, 1, 1]
+    assert loader.calls == 1
+    assert cache.stats()["coalesced"] == 2
+    assert cache.stats()["inflight"] == 0
+
+
+def test_fresh_entries_are_served_from_cache(clock):
+    cache = server.AsyncTTLCache("test", maxsize=8, ttl=60)
+    loader = Loader()
+
+    assert asyncio.run(cache.get_or_load("key", loader)) == 1
+    clock.now += 59
+    assert asyncio.run(cache.get_or_load("key", loader)) == 1
+    assert loader.calls == 1
+    assert cache.hits == 1
+
+
+def test_stale_entries_are_served_while_refreshing(clock):
+    cache = server.AsyncTTLCache("test", maxsize=8, ttl=60, stale_ttl=60)
+    loader = Loader()
+    asyncio.run(cache.get_or_load("key", loader))
+    clock.now += 90
+
+    async def scenario():
+        stale = await asyncio.gather(*(cache.get_or_load("key", loader) for _ in range(3)))
+        # Let the single background refresh finish
+        await asyncio.sleep(0.05)
+        return stale, await cache.get_or_load("key", loader)
+
+    stale, refreshed = asyncio.run(scenario())
+
+    assert stale == [1, 1, 1]
+    assert refreshed == 2
+    assert loader.calls == 2
+    assert cache.stale_hits == 3
+
+
+def test_failed_refresh_keeps_the_stale_entry(clock):
+    cache = server.AsyncTTLCache("test", maxsize=8, ttl=60, stale_ttl=60)
+    asyncio.run(cache.get_or_load("key", Loader()))
+    clock.now += 90
+
+    async def scenario():
+        value = await cache.get_or_load("key", Loader(fail=True))
+        await asyncio.sleep(0.05)
+        return value
+
+    assert asyncio.run(scenario()) == 1
+    assert cache.refresh_errors == 1
+    assert asyncio.run(cache.get_or_load("key", Loader())) == 1
+
+
+def test_expired_entries_are_loaded_again(clock):
+    cache = server.AsyncTTLCache("test", maxsize=8, ttl=60, stale_ttl=60)
+    loader = Loader()
+    asyncio.run(cache.get_or_load("key", loader))
+    clock.now += 121
+
+    assert asyncio.run(cache.get_or_load("key", loader)) == 2
+    assert cache.stale_hits == 0
+
+
+def test_cancelled_caller_does_not_cancel_the_shared_load(clock):
+    cache = server.AsyncTTLCache("test", maxsize=8, ttl=60)
+    loader = Loader()
+
+    async def scenario():
+        first = asyncio.ensure_future(cache.get_or_load("key", loader))
+        second = asyncio.ensure_future(cache.get_or_load("key", loader))
+        await asyncio.sleep(0)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await second
+
+    assert asyncio.run(scenario()) == 1
+    assert loader.calls == 1
+
+
+def test_least_recently_used_entries_are_evicted(clock):
+    cache = server.AsyncTTLCache("test", maxsize=2, ttl=60)
+    for key in ("a", "b", "c"):
+        asyncio.run(cache.get_or_load(key, Loader()))
+
+    assert cache.stats()["size"] == 2
+    assert list(cache._entries) == ["b", "c"]
+
+
+@pytest.mark.parametrize("invalidated", ["key", None])
+def test_invalidation_disowns_loads_in_flight(clock, invalidated):
+    cache = server.AsyncTTLCache("test", maxsize=8, ttl=60)
+    loader = Loader()
+
+    async def scenario():
+        before_write = asyncio.ensure_future(cache.get_or_load("key", loader))
+        await asyncio.sleep(0)
+        cache.invalidate(invalidated)
+        # Must not join the load started before the write
+        after_write = await cache.get_or_load("key", loader)
+        return await before_write, after_write, await cache.get_or_load("key", loader)
+
+    assert asyncio.run(scenario()) == (1, 2, 2)
+    assert loader.calls == 2
+    assert cache.stats()["inflight"] == 0